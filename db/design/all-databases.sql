@@ -1208,6 +1208,38 @@ INSERT INTO `mode_state_default_param` (`id`, `mode_state_default_id`, `name`, `
 /*!40000 ALTER TABLE `mode_state_default_param` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `op_latest`
+--
+
+DROP TABLE IF EXISTS `op_latest`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `op_latest` (
+  `path_hash` char(40) NOT NULL,
+  `operation_name` varchar(64) NOT NULL,
+  `operator_name` varchar(64) NOT NULL,
+  `pid` varchar(32) NOT NULL,
+  `asset_id` varchar(64) NOT NULL,
+  `target_path` varchar(1024) NOT NULL,
+  `status` varchar(64) NOT NULL,
+  `start_time` datetime NOT NULL,
+  `end_time` datetime DEFAULT NULL,
+  `effective_dt` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`path_hash`,`operation_name`,`operator_name`),
+  KEY `idx_op_latest_operation_path` (`operation_name`,`target_path`(255),`operator_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `op_latest`
+--
+
+LOCK TABLES `op_latest` WRITE;
+/*!40000 ALTER TABLE `op_latest` DISABLE KEYS */;
+/*!40000 ALTER TABLE `op_latest` ENABLE KEYS */;
+UNLOCK TABLES;
+
 --
 -- Table structure for table `op_record`
 --
@@ -1,4 +1,4 @@
-import os, sys, thread
+import json, os, sys, thread
 
 import kivy
 kivy.require('1.9.1') # replace with your current kivy version !
@@ -45,13 +45,19 @@ class CacheMonitor(App):
             # print 'Listening to {channel}'.format(**locals())
 
             while True:
-                for item in pubsub.listen():
-                    message = str(item['data']).split('|')
+                # only the latest message is shown, skip any that queued up while the labels were redrawn
+                item = pubsub.get_message(timeout=1.0)
+                latest = None
+                while item is not None:
+                    if item['type'] == 'message':
+                        latest = item
+                    item = pubsub.get_message()
 
-                    if len(message) == 3:
-                        self.operation_lbl.text = message[0]
-                        self.operator_lbl.text = message[1]
-                        self.op_target_lbl.text = message[2]
+                if latest is not None:
+                    message = json.loads(latest['data'])
+                    self.operation_lbl.text = message['operation']
+                    self.operator_lbl.text = message['operator']
+                    self.op_target_lbl.text = '%s (%i, %.1f/s)' % (message['target'], message['count'], message['rate'])
 
         except Exception, err:
             print(err.message)
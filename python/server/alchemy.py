@@ -1,10 +1,12 @@
 import sys
 import time
 import datetime
+import hashlib
+import itertools
 import logging
 from pprint import pprint
 
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Float, Boolean, and_, or_
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Float, Boolean, and_, or_, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
@@ -21,7 +23,7 @@ from db.generated.sqla_media import Asset, FileAttribute, Category, Directory, D
     FileHandler, FileType, FileHandlerRegistration, Matcher, MatcherField, MatchRecord, DirectoryPattern, \
     FileEncoding
 
-from db.generated.sqla_service import ServiceExec, ServiceProfile, OpRecord, ModeDefault, ModeStateDefault, \
+from db.generated.sqla_service import ServiceExec, ServiceProfile, OpLatest, OpRecord, ModeDefault, ModeStateDefault, \
     ModeStateDefaultParam, SwitchRule, t_v_mode_default_dispatch
 
 from db.generated.sqla_service import Mode as AlchemyMode, State as AlchemyState, ModeState as AlchemyModeState
@@ -262,6 +264,14 @@ class SQLDirectoryPattern(DirectoryPattern):
 
         return result
 
+    @staticmethod
+    @alchemy_func
+    def fingerprint():
+        """a summary of the table that changes whenever a pattern is added, removed or edited"""
+        return tuple(sessions[MEDIA].query(func.count(SQLDirectoryPattern.id), func.max(SQLDirectoryPattern.id),
+                                           func.sum(func.crc32(func.concat(SQLDirectoryPattern.pattern, ':',
+                                                                           SQLDirectoryPattern.directory_type_id)))).one())
+
     @staticmethod
     @alchemy_func
     def retrieve_for_pattern(pattern):
@@ -413,6 +423,21 @@ class SQLAsset(Asset):
         except IntegrityError, err:
             raise SQLAlchemyIntegrityError(err, sessions[MEDIA], message=err.message)
 
+    @staticmethod
+    @alchemy_func
+    def insert_all(rows, batch_size=500):
+        """insert rows, dicts of id, asset_type, absolute_path and file_type_id, with one executemany per batch_size
+        rows and a single commit"""
+        table = SQLAsset.__table__
+        try:
+            for start in range(0, len(rows), batch_size):
+                sessions[MEDIA].execute(table.insert(), rows[start:start + batch_size])
+
+            sessions[MEDIA].commit()
+            LOG.debug('inserted %i assets' % len(rows))
+        except IntegrityError, err:
+            raise SQLAlchemyIntegrityError(err, sessions[MEDIA], message=err.message)
+
     @staticmethod
     @alchemy_func
     def retrieve(asset_type, absolute_path=None, use_like=False):
@@ -444,6 +469,43 @@ class SQLAsset(Asset):
 
         return result
 
+    @staticmethod
+    @alchemy_func
+    def retrieve_esids(asset_type, path):
+        """(absolute_path, id) of the current assets of asset_type under path, read as plain rows"""
+        now = datetime.datetime.now()
+        return sessions[MEDIA].query(SQLAsset.absolute_path, SQLAsset.id). \
+            filter(SQLAsset.asset_type == asset_type). \
+            filter(SQLAsset.absolute_path.like('%s%%' % path)). \
+            filter(SQLAsset.effective_dt < now). \
+            filter(SQLAsset.expiration_dt > now).all()
+
+    @staticmethod
+    @alchemy_func
+    def retrieve_ids(asset_type, paths, batch_size=500):
+        """(absolute_path, id) of the current assets of asset_type at paths, with one IN query per batch_size paths"""
+        now = datetime.datetime.now()
+        result = []
+        for start in range(0, len(paths), batch_size):
+            result.extend(sessions[MEDIA].query(SQLAsset.absolute_path, SQLAsset.id). \
+                filter(SQLAsset.asset_type == asset_type). \
+                filter(SQLAsset.absolute_path.in_(paths[start:start + batch_size])). \
+                filter(SQLAsset.effective_dt < now). \
+                filter(SQLAsset.expiration_dt > now).all())
+
+        return result
+
+    @staticmethod
+    @alchemy_func
+    def retrieve_by_ids(ids, batch_size=500):
+        """(id, absolute_path) of the assets with ids, with one IN query per batch_size ids"""
+        result = []
+        for start in range(0, len(ids), batch_size):
+            result.extend(sessions[MEDIA].query(SQLAsset.id, SQLAsset.absolute_path). \
+                filter(SQLAsset.id.in_(ids[start:start + batch_size])).all())
+
+        return result
+
 class SQLFileAttribute(FileAttribute):
 
     file_encoding = relationship("SQLFileEncoding")
@@ -819,6 +881,103 @@ SQLModeStateDefault.default_params = relationship("SQLModeStateDefaultParam", or
                                                   back_populates="mode_state_default")
 
 
+OP_LATEST_COLUMNS = ('path_hash', 'operation_name', 'operator_name', 'pid', 'asset_id', 'target_path', 'status',
+                     'start_time', 'end_time')
+
+# records reach op_latest in key order across pids, not in the order the ops ran, so a row is only replaced by a record
+# that started no earlier. MySQL assigns left to right, start_time goes last so each IF compares against the stored
+# start_time. stored columns are qualified, the backfill's op_record has the same names
+UPDATE_OP_LATEST = """
+        ON DUPLICATE KEY UPDATE
+           pid = IF(VALUES(start_time) >= op_latest.start_time, VALUES(pid), op_latest.pid),
+           asset_id = IF(VALUES(start_time) >= op_latest.start_time, VALUES(asset_id), op_latest.asset_id),
+           target_path = IF(VALUES(start_time) >= op_latest.start_time, VALUES(target_path), op_latest.target_path),
+           status = IF(VALUES(start_time) >= op_latest.start_time, VALUES(status), op_latest.status),
+           end_time = IF(VALUES(start_time) >= op_latest.start_time, VALUES(end_time), op_latest.end_time),
+           start_time = IF(VALUES(start_time) >= op_latest.start_time, VALUES(start_time), op_latest.start_time)"""
+
+UPSERT_OP_LATEST = """
+    INSERT INTO op_latest (%s)
+    VALUES (%s)""" % (', '.join(OP_LATEST_COLUMNS), ', '.join(':' + column for column in OP_LATEST_COLUMNS)) + \
+    UPDATE_OP_LATEST
+
+# op_latest's rows from op_record, for databases that had op records before op_latest existed. path_hash is the sha1
+# of the path's utf-8 bytes, as in SQLOperationLatest.hash_path()
+BACKFILL_OP_LATEST = """
+    INSERT INTO op_latest (%s)
+    SELECT SHA1(CONVERT(target_path USING utf8)), operation_name, operator_name, pid, asset_id, target_path, status,
+           start_time, end_time
+      FROM op_record
+     WHERE status = 'COMPLETE'
+     ORDER BY id""" % ', '.join(OP_LATEST_COLUMNS) + UPDATE_OP_LATEST
+
+
+class SQLOperationLatest(OpLatest):
+    """the latest COMPLETE op record per (target_path, operation, operator), kept up to date as op records are
+    inserted so that freshness checks are index seeks instead of scans over the op_record history"""
+
+    @staticmethod
+    @alchemy_func
+    def backfill():
+        """fill op_latest from op_record if op_latest is empty, so that ops completed before it existed still count.
+        returns the number of rows written"""
+        if sessions[SERVICE].query(SQLOperationLatest.path_hash).first() is not None:
+            return 0
+
+        try:
+            count = sessions[SERVICE].execute(text(BACKFILL_OP_LATEST)).rowcount
+            sessions[SERVICE].commit()
+        except IntegrityError, err:
+            raise SQLAlchemyIntegrityError(err, sessions[SERVICE], message=err.message)
+
+        LOG.info('filled op_latest from %i op records' % count)
+        return count
+
+    @staticmethod
+    def hash_path(target_path):
+        if isinstance(target_path, unicode):
+            target_path = target_path.encode('utf-8')
+        return hashlib.sha1(target_path).hexdigest()
+
+    @staticmethod
+    @alchemy_func
+    def upsert_all(rows):
+        """replace the latest record for each of rows, dicts of op_record column values, unless the stored one started
+        later. the caller commits"""
+        rows = [dict((column, row.get(column)) for column in OP_LATEST_COLUMNS)
+                for row in rows if row['status'] == 'COMPLETE']
+        if len(rows) == 0:
+            return
+
+        for row in rows:
+            row['path_hash'] = SQLOperationLatest.hash_path(row['target_path'])
+        sessions[SERVICE].execute(text(UPSERT_OP_LATEST), rows)
+
+    @staticmethod
+    @alchemy_func
+    def retrieve(path, operation, operator=None):
+        """the latest completed ops for target paths under path"""
+        query = sessions[SERVICE].query(SQLOperationLatest).\
+            filter(SQLOperationLatest.operation_name == operation).\
+            filter(SQLOperationLatest.target_path.like('%s%%' % path))
+        if operator is not None:
+            query = query.filter(SQLOperationLatest.operator_name == operator)
+
+        return tuple(query)
+
+    @staticmethod
+    @alchemy_func
+    def retrieve_for_path(path, operation, operator=None):
+        """the latest completed ops for exactly path, a primary key lookup"""
+        query = sessions[SERVICE].query(SQLOperationLatest).\
+            filter(SQLOperationLatest.path_hash == SQLOperationLatest.hash_path(path)).\
+            filter(SQLOperationLatest.operation_name == operation)
+        if operator is not None:
+            query = query.filter(SQLOperationLatest.operator_name == operator)
+
+        return tuple(query)
+
+
 class SQLOperationRecord(OpRecord):
 
     @staticmethod
@@ -834,28 +993,57 @@ class SQLOperationRecord(OpRecord):
 
         try:
             sessions[SERVICE].add(op_rec)
+            SQLOperationLatest.upsert_all([{'pid': config.pid, 'operation_name': operation_name,
+                'operator_name': operator_name, 'asset_id': asset_id, 'target_path': target_path,
+                'start_time': start_time, 'end_time': op_rec.end_time, 'status': status}])
             sessions[SERVICE].commit()
         except IntegrityError, err:
             raise SQLAlchemyIntegrityError(err, sessions[SERVICE], message=err.message)
 
 
+    @staticmethod
+    @alchemy_func
+    def insert_all(records, batch_size=500):
+        """insert records, dicts of insert()'s arguments, with one executemany per batch_size rows and a single commit"""
+        table = SQLOperationRecord.__table__
+        records = iter(records)
+        count = 0
+        try:
+            while True:
+                rows = [dict(record, pid=config.pid, end_time=None if record['end_time'] == 'None' else record['end_time'])
+                        for record in itertools.islice(records, batch_size)]
+                if len(rows) == 0:
+                    break
+                sessions[SERVICE].execute(table.insert(), rows)
+                SQLOperationLatest.upsert_all(rows)
+                count += len(rows)
+
+            sessions[SERVICE].commit()
+            LOG.debug('inserted %i op records' % count)
+        except IntegrityError, err:
+            raise SQLAlchemyIntegrityError(err, sessions[SERVICE], message=err.message)
+
+
     @staticmethod
     @alchemy_func
     def retrieve(path, operation, operator=None, apply_lifespan=False, op_status=None):
+        op_status = 'COMPLETE' if op_status is None else op_status
+        if op_status == 'COMPLETE':
+            return SQLOperationLatest.retrieve(path, operation, operator)
+
         # path = '%s%s%s' % (path, os.path.sep, '%') if not path.endswith(os.path.sep) else
         path = '%s%s' % (path, '%')
-        op_status = 'COMPLETE' if op_status is None else op_status
 
         result = ()
         if operator is None:
             for instance in sessions[SERVICE].query(SQLOperationRecord).\
-                filter(SQLOperationRecord.target_path.like('%s%s' % (path, '%'))).\
+                filter(SQLOperationRecord.target_path.like(path)).\
                 filter(SQLOperationRecord.operation_name == operation).\
                 filter(SQLOperationRecord.status == op_status):
                     result += (instance,)
         else:
             for instance in sessions[SERVICE].query(SQLOperationRecord).\
-                filter(SQLOperationRecord.target_path.like('%s%s' % (path, '%'))).\
+                filter(SQLOperationRecord.target_path.like(path)).\
                 filter(SQLOperationRecord.operation_name == operation).\
                 filter(SQLOperationRecord.operator_name == operator).\
                 filter(SQLOperationRecord.status == op_status):
@@ -1,13 +1,16 @@
 #!/usr/bin/python
+import atexit
 import json
 import logging
 import os
 import pprint
+import stat
 import sys
 import time
 import copy
+import uuid
 
-from elasticsearch.exceptions import ConnectionError, RequestError
+from elasticsearch.exceptions import ConnectionError, RequestError, TransportError
 import shallow
 
 import const
@@ -18,6 +21,9 @@ import sql
 from alchemy import SQLAsset, SQLFileType, SQLDirectoryType, SQLDirectoryPattern
 from const import DIRECTORY, MATCH
 from core import cache2, log, util
+from core.patterns import PatternSet
+from core.journal import Journal
+from core.prefixes import PrefixIndex
 from errors import AssetException, ElasticDataIntegrityException
 from ops import ops_func
 
@@ -30,6 +36,11 @@ RETRIEVE_DOCS = 'cache_retrieve_docs'
 
 pp = pprint.PrettyPrinter(indent=4)
 
+# cached assets are budgeted per asset type, in paths rather than in the root hashes that hold them. cached matches
+# expire with the op lifespan
+cache2.set_policy(KEY_GROUP, limit=config.asset_cache_size, depth=2, count_fields=True)
+cache2.set_policy(MATCH, ttl=config.op_life * ops.DAY)
+
 PATTERN = 'pattern'
 COMPILATION = 'compilation'
 EXTENDED = 'extended'
@@ -44,11 +55,27 @@ UNSORTED = 'unsorted'
 ALBUM = 'album'
 NO_SCAN = 'no_scan'
 
+def stat_path(path):
+    """os.stat(path), or None if path can't be reached"""
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def readable(path, stat_result):
+    """whether path, stat'ed as stat_result, can be read. mode bits alone can't tell on NFS with root_squash or on ACL
+    and SMB mounts, so access is left to os.access()"""
+    return stat_result is not None and os.access(path, os.R_OK)
+
+
 class Asset(object):
-    def __init__(self, absolute_path, asset_type, esid=None):
+    def __init__(self, absolute_path, asset_type, esid=None, stat_result=None):
+        """every file system field is derived from stat_result, absolute_path is stat'ed once if it is not given"""
         # self.active = True
         self.absolute_path = absolute_path
-        self.available = os.access(absolute_path, os.R_OK)
+        self._stat = stat_path(absolute_path) if stat_result is None else stat_result
+        self.available = readable(absolute_path, self._stat)
         self.deleted = False
         self.asset_type = asset_type
         self.errors = []
@@ -71,12 +98,13 @@ class Asset(object):
 
         data = {}
         for name in self.__dict__: 
-            data[name] = self.__dict__[name]
+            if not name.startswith('_'):
+                data[name] = self.__dict__[name]
 
         if self.available:
-            data['ctime'] = time.ctime(os.path.getctime(self.absolute_path))
-            data['mtime'] = time.ctime(os.path.getmtime(self.absolute_path))
-            data['file_size'] = os.path.getsize(self.absolute_path)
+            data['ctime'] = time.ctime(self._stat.st_ctime)
+            data['mtime'] = time.ctime(self._stat.st_mtime)
+            data['file_size'] = self._stat.st_size
        
         return data
 
@@ -85,9 +113,9 @@ class Asset(object):
 
 
 class Document(Asset):
-    def __init__(self, absolute_path, esid=None):
-        super(Document, self).__init__(absolute_path, asset_type=const.FILE, esid=esid)
-        self.available = self.available and os.path.isfile(absolute_path)       
+    def __init__(self, absolute_path, esid=None, stat_result=None):
+        super(Document, self).__init__(absolute_path, asset_type=const.FILE, esid=esid, stat_result=stat_result)
+        self.available = self.available and stat.S_ISREG(self._stat.st_mode)
         self.ext = None
         self.file_name = None
         self.file_size = 0
@@ -109,18 +137,20 @@ class Document(Asset):
 
 
 class Directory(Asset):
-    def __init__(self, absolute_path, esid=None):
-        super(Directory, self).__init__(absolute_path, asset_type=const.DIRECTORY, esid=esid)
-        self.available = self.available and os.path.isdir(absolute_path)
+    def __init__(self, absolute_path, esid=None, stat_result=None, contents=None):
+        """contents, the names in the directory, saves listing it again when they are already known"""
+        super(Directory, self).__init__(absolute_path, asset_type=const.DIRECTORY, esid=esid, stat_result=stat_result)
+        self.available = self.available and stat.S_ISDIR(self._stat.st_mode)
+        self._contents = contents
 
     # TODO: call Asset.to_dictionary and append values
     def to_dictionary(self):
 
         data = super(Directory, self).to_dictionary()
         if self.available:
-            data['ctime'] = time.ctime(os.path.getctime(self.absolute_path))
             try:
-                data['contents'] = [util.uu_str(f) for f in os.listdir(self.absolute_path)]
+                names = os.listdir(self.absolute_path) if self._contents is None else self._contents
+                data['contents'] = [util.uu_str(f) for f in names]
                 data['contents'].sort()
             except Exception, err:
                 # self.has_errors = True
@@ -144,22 +174,55 @@ class Directory(Asset):
     #     return False
 
 
-def directory_attribs(directory):
-    data = directory.to_dictionary()
-    data['attributes'] = {}
+class DirectoryPatterns(object):
+    """classifies directories by the directory_pattern table. the patterns are compiled into one PatternSet, so a path
+    is classified in a single pass. the table is checked at most every refresh seconds and the set is rebuilt only when
+    its fingerprint changed"""
+    def __init__(self, refresh=60):
+        self.refresh = refresh
+        self.checked = None
+        self.fingerprint = None
+        self.types = {}
+        self.type_names = []
+        self.patterns = PatternSet([])
 
-    sql_patterns = SQLDirectoryPattern.retrieve_all()
-    for pattern in sql_patterns:
-        data['attributes'][pattern.directory_type.name] = False 
+    def invalidate(self):
+        self.checked = None
 
-    patterns = shallow.get_directory_patterns()
-    for term in patterns:
-        if term in directory.absolute_path and term not in os.path.split(directory.absolute_path)[1]:
-            for pattern in sql_patterns:
-                if pattern.pattern == term:
-                        data['attributes'][pattern.directory_type.name] = True  
+    def _load(self):
+        if self.checked is not None and time.time() - self.checked < self.refresh:
+            return
 
+        self.checked = time.time()
+        fingerprint = SQLDirectoryPattern.fingerprint()
+        if fingerprint == self.fingerprint:
+            return
 
+        types = {}
+        for row in SQLDirectoryPattern.retrieve_all():
+            types.setdefault(row.pattern, set()).add(row.directory_type.name)
+
+        self.types = types
+        self.type_names = sorted(set(name for names in types.values() for name in names))
+        self.patterns = PatternSet(types.keys())
+        self.fingerprint = fingerprint
+
+    def classify(self, path):
+        """return {directory type name: True if one of its patterns is in path, but not in the directory's name}"""
+        self._load()
+        result = dict((name, False) for name in self.type_names)
+        for pattern in self.patterns.search(path) - self.patterns.search(os.path.split(path)[1]):
+            for name in self.types[pattern]:
+                result[name] = True
+
+        return result
+
+
+DIRECTORY_PATTERNS = DirectoryPatterns(refresh=config.pattern_refresh)
+
+def directory_attribs(directory):
+    data = directory.to_dictionary()
+    data['attributes'] = DIRECTORY_PATTERNS.classify(directory.absolute_path)
     return data
 
 
@@ -186,7 +249,8 @@ def clear_directory_cache():
 
 
 def get_cached_directory():
-    return cache2.get_hash2(get_cache_key())
+    # read once per file, name the key directly rather than through get_cache_key() to avoid the EXISTS
+    return cache2.get_hash2(cache2.key_name(KEY_GROUP), local=True)
 
 
 def pattern_in_path(pattern, path):
@@ -199,16 +263,27 @@ def pattern_in_path(pattern, path):
     return False
 
 @ops_func
-def set_active_directory(path):
+def set_active_directory(path, contents=None):
     clear_directory_cache()
-    directory = None if path is None else Directory(util.uu_str(path))
+    directory = None if path is None else Directory(util.uu_str(path), contents=contents)
 
     if directory is not None:
         LOG.debug('syncing metadata for %s' % directory.absolute_path)
         ops.update_listeners('syncing metadata', 'assets', path)
-        if search.unique_doc_exists(DIRECTORY, 'absolute_path', directory.absolute_path, except_on_multiples=True):
-            directory.esid = search.unique_doc_id(DIRECTORY, 'absolute_path', directory.absolute_path)
-        else:
+        # a directory waiting in the outbox is in neither Elasticsearch nor the asset table yet
+        directory.esid = INDEXER.deferred_esid(DIRECTORY, directory.absolute_path)
+        if directory.esid is None:
+            try:
+                if search.unique_doc_exists(DIRECTORY, 'absolute_path', directory.absolute_path,
+                                            except_on_multiples=True):
+                    directory.esid = search.unique_doc_id(DIRECTORY, 'absolute_path', directory.absolute_path)
+            except ConnectionError:
+                if INDEXER.outbox is None:
+                    raise
+                # Elasticsearch is unavailable, the asset table has the directories indexed so far
+                directory.esid = retrieve_esid(DIRECTORY, directory.absolute_path)
+
+        if directory.esid is None:
             directory.location = get_library_location(path)
             data = directory_attribs(directory)
             file_type = SQLFileType.retrieve('directory')
@@ -217,7 +292,16 @@ def set_active_directory(path):
         cache_directory(directory)
 
 
-# asset cache
+# asset cache: each cached root has one hash of absolute_path -> esid under the compound key (KEY_GROUP, asset_type,
+# root), so warming a root is a few HMSETs and a lookup is one HGET
+
+# fields per HMSET when caching a root
+DOCS_PER_WRITE = 1000
+
+# asset_type -> PrefixIndex of the roots cached by this process, see cache_docs()
+cached_roots = {}
+# compound key -> the root it caches, key names are cleaned and cannot be turned back into paths
+cached_keys = {}
 
 @ops_func
 def cache_docs(asset_type, path, flush=True):
@@ -226,40 +310,58 @@ def cache_docs(asset_type, path, flush=True):
 
     ops.update_listeners('retrieving assets', 'assets', path)
     LOG.debug('retrieving %s records for %s...' % (asset_type, path))
-    rows = SQLAsset.retrieve(asset_type, path, use_like=True)
+    rows = SQLAsset.retrieve_esids(asset_type, path)
 
-    count = len(rows)
-    cached_count = 0
+    ops.update_listeners('caching %i %s records...' % (len(rows), asset_type), 'assets', path)
+    cache_esids(asset_type, path, dict(rows))
 
-    for sql_asset in rows:
-        ops.update_listeners('caching %i of %i %s records...' % (cached_count, count, sql_asset.asset_type), 'assets', sql_asset.absolute_path)
-        cache_sql_asset(sql_asset)
-        cached_count += 1
 
-@ops_func
-def cache_sql_asset(sql_asset):
-    key = cache2.create_key(KEY_GROUP, sql_asset.asset_type, sql_asset.absolute_path, value=sql_asset.absolute_path)
-    cache2.set_hash2(key, {'absolute_path': sql_asset.absolute_path, 'esid': sql_asset.id})
+def cache_esids(asset_type, root, esids):
+    """add esids, a dict of absolute_path -> esid, to the hash cached for root"""
+    key = cache2.get_key(KEY_GROUP, asset_type, root)
+    paths = esids.keys()
+    with cache2.batch():
+        for start in range(0, len(paths), DOCS_PER_WRITE):
+            cache2.update_hash2(key, dict((path, esids[path]) for path in paths[start:start + DOCS_PER_WRITE]))
+
+    cached_roots.setdefault(asset_type, PrefixIndex()).add(root)
+    cached_keys[key] = root
+    # the oldest roots give way once the asset type holds more than asset_cache_size paths
+    for evicted in cache2.enforce_policy(key):
+        if evicted in cached_keys:
+            cached_roots[asset_type].remove(cached_keys.pop(evicted))
 
 
 def clear_docs(asset_type, path):
     LOG.info('clearing %s asset cache' % path)
-    keys = cache2.get_keys(KEY_GROUP, asset_type, path)
-    for key in keys:
-        cache2.delete_key(key)
+    keys = cache2.iter_keys(KEY_GROUP, asset_type, path)
+    with cache2.batch():
+        for key in keys:
+            cache2.delete_key(key)
+            cached_keys.pop(key, None)
+
+    roots = cached_roots.get(asset_type, PrefixIndex())
+    for root in roots:
+        if root.startswith(path):
+            roots.remove(root)
+
+
+def get_cached_root(asset_type, path):
+    """the longest cached root containing path, or None"""
+    if asset_type in cached_roots:
+        return cached_roots[asset_type].longest(path)
 
 
 def get_cached_esid(asset_type, path):
-    key = cache2.get_key(KEY_GROUP, asset_type, path)
-    values = cache2.get_hash2(key)
-    if 'esid' in values:
-        return values['esid']
+    root = get_cached_root(asset_type, path)
+    if root is not None:
+        return cache2.get_hash_value2(cache2.key_name(KEY_GROUP, asset_type, root), path)
 
 
-def get_doc_keys(asset_type):
-    keys = cache2.get_keys(KEY_GROUP, asset_type)
-    return keys
-    
+def get_cached_docs(asset_type, root):
+    """absolute_path -> esid for every doc cached for root"""
+    return cache2.get_hash2(cache2.key_name(KEY_GROUP, asset_type, root))
+
 
 def retrieve_docs(asset_type, path):
     return sql.run_query_template(RETRIEVE_DOCS, asset_type, path, schema=config.db_media)
@@ -272,10 +374,8 @@ def doc_exists_for_path(asset_type, path):
         else True
 
 
-def retrieve_asset(absolute_path, esid=None, check_cache=True, check_db=True):
-    """return a asset instance"""
-    
-    asset = Document(util.uu_str(absolute_path), esid=esid)
+def new_document(absolute_path, esid=None, stat_result=None):
+    asset = Document(util.uu_str(absolute_path), esid=esid, stat_result=stat_result)
     filename = os.path.split(absolute_path)[1]
     extension = os.path.splitext(absolute_path)[1]
     filename = filename.replace(extension, '')
@@ -284,10 +384,52 @@ def retrieve_asset(absolute_path, esid=None, check_cache=True, check_db=True):
     asset.esid = esid
     asset.ext = extension
     asset.file_name = filename
+    return asset
+
+
+def resolve_assets(paths, check_cache=True, check_db=True):
+    """return absolute_path -> asset instance for paths, e.g. a directory listing. esids are read from the cache with
+    one HMGET per cached root and the remainder from the db with one query"""
+    result = {}
+    locations = {}
+    for path in paths:
+        directory = os.path.dirname(path)
+        if directory not in locations:
+            locations[directory] = get_library_location(path)
+
+        result[path] = new_document(path)
+        result[path].location = locations[directory]
+
+    if check_cache:
+        cached = {}
+        for path in paths:
+            root = get_cached_root(const.FILE, path)
+            if root is not None:
+                cached.setdefault(root, []).append(path)
+
+        for root in cached:
+            esids = cache2.get_hash_values2(cache2.key_name(KEY_GROUP, const.FILE, root), cached[root])
+            for path, esid in zip(cached[root], esids):
+                result[path].esid = esid
+
+    missing = [path for path in paths if result[path].esid is None]
+    if check_db and len(missing) > 0:
+        rows = SQLAsset.retrieve_ids(const.FILE, missing, batch_size=config.sql_batch_size)
+        found = dict((util.uu_str(path), esid) for path, esid in rows)
+        for path in missing:
+            result[path].esid = found.get(util.uu_str(path))
+
+    return result
+
+
+def retrieve_asset(absolute_path, esid=None, check_cache=True, check_db=True):
+    """return a asset instance"""
+    
+    asset = new_document(absolute_path, esid=esid)
     asset.location = get_library_location(absolute_path)
 
     # check cache for esid
-    if check_cache and asset.esid is None and get_cached_esid(asset.asset_type, absolute_path):
+    if check_cache and asset.esid is None:
         asset.esid = get_cached_esid(asset.asset_type, absolute_path)
 
     # check db for esid
@@ -305,6 +447,11 @@ def index_asset(data):
 ATTRIBUTES = 'attributes'
 FAILED_TO_PARSE = 'failed to parse'
 
+# _bulk actions
+INDEX = 'index'
+UPDATE = 'update'
+UPSERT = 'upsert'
+
 def create_asset_metadata(data, file_type):
     try:
         # LOG.debug("indexing %s: %s" % (asset.asset_type, asset.absolute_path))
@@ -318,27 +465,13 @@ def create_asset_metadata(data, file_type):
         print('Error encountered handling %s:' % (data['absolute_path']))
         pp.pprint(err.args[2])
        
-        error_string = err.args[2]['error']['reason']
-        if error_string.startswith(FAILED_TO_PARSE):
-            # try:
-            error_field = error_string.replace(FAILED_TO_PARSE, '').replace('[', '').replace(']', '').strip()
-            error_type = err.args[2]['error']['type']
-            error_cause =  err.args[2]['error']['caused_by']['reason']
-
-            if error_field.startswith(ATTRIBUTES):
-                error_field = error_field.replace('%s.' % ATTRIBUTES, '').strip()
-                for index in range(len(data[ATTRIBUTES])):
-                    props = data[ATTRIBUTES][index]
-                    if props[error_field] == error_cause:
-                        props[error_field] = None
-                        data[ATTRIBUTES][index] = props
-
-                        return create_asset_metadata(data, file_type)
-            # except Exception, err3:
-            #     ERR.error("LOGGING ERROR %s" % err3.args[0])
+        if repair_document(data, err.args[2]['error']):
+            return create_asset_metadata(data, file_type)
         raise Exception(err, err.message)
         
     except ConnectionError, err:
+        if INDEXER.outbox is not None:
+            return INDEXER.defer(data, file_type)
         return wait_and_resubmit_asset(err, data, file_type)
 
     except AssetException, err:
@@ -352,6 +485,26 @@ def create_asset_metadata(data, file_type):
                 
     return True        
 
+def repair_document(data, error):
+    """clear the attribute value that error, an Elasticsearch error object, reports it failed to parse. returns True
+    if data was changed and is worth resubmitting"""
+    error_string = error.get('reason') or ''
+    if not error_string.startswith(FAILED_TO_PARSE) or 'caused_by' not in error:
+        return False
+
+    error_field = error_string.replace(FAILED_TO_PARSE, '').replace('[', '').replace(']', '').strip()
+    error_cause = error['caused_by']['reason']
+    if not error_field.startswith(ATTRIBUTES):
+        return False
+
+    error_field = error_field.replace('%s.' % ATTRIBUTES, '').strip()
+    for props in data[ATTRIBUTES]:
+        if error_field in props and props[error_field] == error_cause:
+            props[error_field] = None
+            return True
+
+    return False
+
 @ops_func
 def wait_and_resubmit_asset(err, data, file_type):
     # TODO: if ES doesn't become available after alloted time or number of retries, INVALIDATE ALL READ OPERATIONS FOR THIS ASSET
@@ -374,6 +527,229 @@ def resubmit_asset(data, file_type):
     except ConnectionError, err:
         print("Elasticsearch connectivity error, retrying in 5 seconds...")
 
+# bulk indexing
+
+# replaces the reader attribute blocks named in params.readers and sets the top level fields, leaving the rest of the
+# document in place
+UPDATE_ATTRIBUTES = ' '.join([
+    'if (ctx._source.attributes == null) { ctx._source.attributes = []; }',
+    'ctx._source.attributes.removeIf(attribute -> params.readers.contains(attribute._reader));',
+    'ctx._source.attributes.addAll(params.attributes);',
+    'ctx._source.putAll(params.fields);'])
+
+class AssetIndexer(object):
+    """buffers asset documents and writes each batch of size documents to Elasticsearch with one _bulk request, and new
+    ones to MySQL with one multi-row insert. esids are assigned here, so callers have them before the write and a batch
+    resent after a lost connection replaces its documents instead of duplicating them. add() and update() write a full
+    buffer themselves, so the scan waits on Elasticsearch rather than running ahead of it.
+
+    with an outbox (see open_outbox()) batches that can't reach Elasticsearch are appended to it instead, and the scan
+    carries on. the outbox is written out by a later flush(), once retry seconds have passed. documents written from the
+    outbox have no on_error callback, failures are logged only"""
+    def __init__(self, size=500, retries=3):
+        self.size = size
+        self.retries = retries
+        self.pending = []
+        self.outbox = None
+        # (asset_type, absolute_path) -> esid of the new documents in the outbox
+        self.deferred = {}
+        self.retry = 5
+        # when to try Elasticsearch again, None while it is available
+        self.retry_at = None
+
+    def add(self, data, file_type, on_error=None):
+        """queue data for indexing and return its esid. on_error is called with data if it can't be indexed"""
+        data['esid'] = uuid.uuid4().hex
+        self._queue(INDEX, data, None if file_type is None else file_type.id, on_error)
+        return data['esid']
+
+    def update(self, data, on_error=None):
+        """queue a scripted update of the document data['esid'], sending only data's attribute blocks and top level
+        fields. on_error is called with data if it can't be updated"""
+        self._queue(UPDATE, data, None, on_error)
+        return data['esid']
+
+    def defer(self, data, file_type):
+        """write data to the outbox, to be indexed once Elasticsearch is available, and return its esid"""
+        data['esid'] = uuid.uuid4().hex
+        self._spool([(INDEX, data, None if file_type is None else file_type.id, None)])
+        return data['esid']
+
+    def deferred_esid(self, asset_type, absolute_path):
+        """the esid of the document for absolute_path, if it is waiting in the outbox"""
+        return self.deferred.get((asset_type, absolute_path))
+
+    def _queue(self, action, data, file_type_id, on_error):
+        self.pending.append((action, data, file_type_id, on_error))
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if self.outbox is not None and not self.drain():
+            self._spool(batch)
+            return
+
+        self._write(batch)
+
+    def drain(self):
+        """write out the outbox, returns False while Elasticsearch is unavailable"""
+        if self.retry_at is not None:
+            if time.time() < self.retry_at:
+                return False
+            config.es = search.connect(config.es_host, config.es_port)
+            self.retry_at = None
+
+        entries = self.outbox.take()
+        if len(entries) > 0:
+            LOG.info('writing %i documents from the outbox' % len(entries))
+
+        for start in range(0, len(entries), self.size):
+            batch = [(entry['action'], entry['data'], entry['file_type_id'], None)
+                     for entry in entries[start:start + self.size]]
+            if not self._write(batch):
+                # _write() returned this batch to the outbox, the rest goes back behind it
+                for entry in entries[start + self.size:]:
+                    self.outbox.append(entry)
+                self.outbox.done()
+                return False
+
+            for action, data, file_type_id, on_error in batch:
+                self.deferred.pop((data['asset_type'], data['absolute_path']), None)
+
+        self.outbox.done()
+        return True
+
+    def _spool(self, batch):
+        for action, data, file_type_id, on_error in batch:
+            self.outbox.append({'action': action, 'data': data, 'file_type_id': file_type_id})
+            if action == INDEX:
+                self.deferred[(data['asset_type'], data['absolute_path'])] = data['esid']
+
+    def _write(self, batch):
+        """write batch with as many _bulk requests as its retries take. returns False if Elasticsearch could not be
+        reached and the batch went to the outbox"""
+        attempt = 0
+        while len(batch) > 0:
+            try:
+                response = config.es.bulk(body=self._bulk_body(batch))
+            except ConnectionError, err:
+                ERR.error(err.__class__.__name__)
+                if self.outbox is not None:
+                    ERR.warning('Elasticsearch is unavailable, %i documents sent to the outbox, retrying in %i seconds'
+                                % (len(batch), self.retry))
+                    self._spool(batch)
+                    self.retry_at = time.time() + self.retry
+                    return False
+
+                print("Elasticsearch connectivity error, retrying in 5 seconds...")
+                time.sleep(5)
+                config.es = search.connect(config.es_host, config.es_port)
+                continue
+            except TransportError, err:
+                for entry in batch:
+                    self._fail(entry, err)
+                return True
+
+            indexed = []
+            retry = []
+            for entry, item in zip(batch, response['items']):
+                action, data, file_type_id, on_error = entry
+                result = item.values()[0]
+                if result['status'] < 300:
+                    if action == INDEX:
+                        indexed.append(entry)
+                elif attempt >= self.retries:
+                    self._fail(entry, result.get('error'))
+                # 429 and 503 are rejections by a busy cluster, 409 a conflict that outlasted retry_on_conflict
+                elif result['status'] in (409, 429, 503):
+                    retry.append(entry)
+                # the document is gone, an upsert puts it back under its esid
+                elif result['status'] == 404 and action == UPDATE:
+                    retry.append((UPSERT, data, file_type_id, on_error))
+                # a parse error may be repaired by dropping the value
+                elif repair_document(data, result.get('error', {})):
+                    retry.append(entry)
+                else:
+                    self._fail(entry, result.get('error'))
+
+            self._insert(indexed)
+            batch = retry
+            attempt += 1
+            if len(batch) > 0:
+                time.sleep(0.5 * 2 ** attempt)
+
+        return True
+
+    def _bulk_body(self, batch):
+        lines = []
+        for action, data, file_type_id, on_error in batch:
+            meta = {'_index': data['asset_type'], '_type': data['asset_type'], '_id': data['esid']}
+            if action == INDEX:
+                lines.append(json.dumps({INDEX: meta}))
+                lines.append(json.dumps(dict((key, data[key]) for key in data if key != 'esid')))
+                continue
+
+            meta['retry_on_conflict'] = self.retries
+            attributes = data.get(ATTRIBUTES, [])
+            params = {'readers': [attribute['_reader'] for attribute in attributes], 'attributes': attributes,
+                      'fields': dict((key, data[key]) for key in data if key not in ('esid', ATTRIBUTES))}
+            body = {'script': {'source': UPDATE_ATTRIBUTES, 'lang': 'painless', 'params': params}}
+            if action == UPSERT:
+                body['upsert'] = dict((key, data[key]) for key in data if key != 'esid')
+
+            lines.append(json.dumps({UPDATE: meta}))
+            lines.append(json.dumps(body))
+
+        return '\n'.join(lines) + '\n'
+
+    def _insert(self, indexed):
+        rows = [{'id': data['esid'], 'asset_type': data['asset_type'], 'absolute_path': data['absolute_path'],
+                 'file_type_id': file_type_id} for action, data, file_type_id, on_error in indexed]
+        try:
+            SQLAsset.insert_all(rows, batch_size=config.sql_batch_size)
+        except Exception:
+            # a batch resent after a lost connection may have been stored already, its rows are done. otherwise one
+            # bad row fails the whole insert, insert the rows one by one to find it
+            stored = dict(SQLAsset.retrieve_by_ids([row['id'] for row in rows]))
+            for row, entry in zip(rows, indexed):
+                if stored.get(row['id']) == row['absolute_path']:
+                    continue
+                try:
+                    SQLAsset.insert_all([row])
+                except Exception, err:
+                    config.es.delete(row['asset_type'], row['asset_type'], row['id'])
+                    self._fail(entry, err.message)
+
+    def _fail(self, entry, error):
+        action, data, file_type_id, on_error = entry
+        ERR.error('unable to %s %s: %s' % (action, data['absolute_path'], error))
+        if on_error:
+            on_error(data)
+
+
+INDEXER = AssetIndexer(size=config.es_bulk_size, retries=config.es_bulk_retries)
+atexit.register(INDEXER.flush)
+
+def open_outbox(path, retry=5):
+    """write documents to this process's outbox at path while Elasticsearch is unavailable, and write out whatever
+    exited processes left there. replaying is safe if some of it was written already: documents are indexed under
+    their own esids and rows already in the asset table are skipped"""
+    INDEXER.outbox = Journal(path, pid=config.pid)
+    INDEXER.retry = retry
+    INDEXER.retry_at = None
+    INDEXER.deferred = dict(((entry['data']['asset_type'], entry['data']['absolute_path']), entry['data']['esid'])
+                            for entry in INDEXER.outbox.pending if entry['action'] == INDEX)
+
+def queue_asset_metadata(data, file_type, on_error=None):
+    """like create_asset_metadata(), but the document is written with the rest of its batch"""
+    return INDEXER.add(data, file_type, on_error)
+
+
+def flush_asset_metadata():
+    INDEXER.flush()
+
+
 def retrieve_esid(asset_type, absolute_path):
     cached = get_cached_esid(asset_type, absolute_path)
     if cached: 
@@ -399,36 +775,13 @@ def strip_esid(values):
     return result
 
 
-def update_asset(data):
-    try:
-        if data['esid']:
-            old_doc = search.get_doc(data['asset_type'], data['esid'])
-            old_data = old_doc['_source']['attributes']
-
-            updated_reads = []
-            for index in range(len(data['attributes'])):
-                updated_reads.append(data['attributes'][index]['_reader'])
-
-            for index in range(len(old_data)):
-                if old_data[index]['_reader'] not in updated_reads:
-                    data['attributes'].append(old_data[index])
-
-            try:
-                res = config.es.update(index=data['asset_type'], doc_type=data['asset_type'], id=data['esid'], body=json.dumps({'doc': strip_esid(data)}))
-                if res['_shards']['successful'] == 1:
-                    return res['_id']
-            except RequestError, err:
-                ERR.error(err.__class__.__name__)
-                print('RequestError encountered handling %s:' % (data['absolute_path']))
-                pp.pprint(err.args[2])
-                # raise Exception(err)
-            except Exception, err:
-                raise Exception(err)
-        else:
-            return create_asset_metadata(data)  
-    except ElasticDataIntegrityException, err:
-        handle_asset_exception(err, data['absolute_path'])
-        update_asset(data)
+def update_asset(data, on_error=None):
+    """queue an update of data's document in which the attribute blocks of the readers in data replace theirs and the
+    others are kept. the document is not read back, the change is applied by a script in Elasticsearch"""
+    if data['esid']:
+        return INDEXER.update(data, on_error)
+    else:
+        return create_asset_metadata(data)  
 
 
 # matched files
@@ -463,26 +816,8 @@ def clear_matches(matcher_name, esid):
 # util
 
 def get_library_location(path):
-    # LOG.debug("determining location for %s." % (path.split(os.path.sep)[-1]))
-    possible = []
-
-    for location in shallow.get_directories():
-        if location in path:
-	        possible.append(location)
-    
-    if len(possible) == 1:
-    	return possible[0]
-
-    result = None
-    LOG.debug("indexing %s" % (path))
-
-    if len(possible) > 1:
-      result = possible[0]
-      for item in possible:
-	    if len(item) > len(result):
-	        result = item
-
-    return result
+    """the library directory containing path, the innermost if directories are nested, or None"""
+    return shallow.get_directory_index().longest(path)
 
 
 def path_in_db(path, asset_type):
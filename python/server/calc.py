@@ -37,6 +37,7 @@ def calc(vector, cycle_vector=False):
     sql.execute_query("delete from match_record where 1=1", schema=config.db_media)
     sql.execute_query("delete from op_record where operation_name = 'calc'", schema=config.db_service)
     sql.execute_query("delete from op_record where operation_name = 'match'", schema=config.db_service)
+    sql.execute_query("delete from op_latest where operation_name in ('calc', 'match')", schema=config.db_service)
     # sql.execute_query("commit", schema=config.db_service)
 
     # MAX_RECORDS = ...
@@ -60,17 +61,12 @@ def calc(vector, cycle_vector=False):
         ops.cache_ops(location, MATCH, apply_lifespan=True)
         assets.cache_matches(location)
 
-        for key in assets.get_doc_keys(FILE):
+        for absolute_path, esid in assets.get_cached_docs(FILE, location).iteritems():
             opcount += 1
             # ops.check_status(opcount)
 
-            values = cache2.get_hash2(key)
-            if 'esid' not in values:
-                LOG.debug('match calculator skipping %s' % (key))
-                continue
-                
             try:
-                match.do_match_op(values['esid'], values['absolute_path'], matchers)
+                match.do_match_op(esid, absolute_path, matchers)
             except Exception, err:
                 print(err.message)
 
@@ -84,7 +80,7 @@ def calc(vector, cycle_vector=False):
 
 
 def main(args):
-    import redis
+    import start
 
     # sql.execute_query("delete from match_record")
     # sql.execute_query("delete from op_record where operation_name = 'calc'")
@@ -92,7 +88,7 @@ def main(args):
     # sql.execute_query("commit");
 
     config.es = search.connect()
-    cache2.datastore = redis.Redis('localhost')
+    start.initialize_cache2(config.redis_host, shared=config.redis_shared, backend=config.redis_backend)
     log.start_logging()
     paths = None if not args['--path'] else args['<path>']
     vector = PathVector('_path_vector_', paths)
@@ -50,6 +50,13 @@ if (os.path.isfile(config_file)):
     # elasticsearch
     es_host = read(parser, "Elasticsearch")['host']
     es_port = int(read(parser, "Elasticsearch")['port'])
+    # new file documents per _bulk request, and how often a rejected document is resent
+    es_bulk_size = int(read(parser, "Elasticsearch").get('bulk_size', 500))
+    es_bulk_retries = int(read(parser, "Elasticsearch").get('bulk_retries', 3))
+    # where documents wait while Elasticsearch is unavailable, with the pid added as for the op journal, and how many
+    # seconds apart it is tried again
+    es_outbox = read(parser, "Elasticsearch").get('outbox', 'assets.outbox')
+    es_outbox_retry = float(read(parser, "Elasticsearch").get('outbox_retry', 5))
 
     # mysql
     mysql_host = read(parser, "MySQL")['host']
@@ -57,6 +64,8 @@ if (os.path.isfile(config_file)):
     mysql_user = read(parser, "MySQL")['user']
     mysql_pass = read(parser, "MySQL")['pass']
     mysql_port = int(read(parser, "MySQL")['port'])
+    # rows per multi-row insert
+    sql_batch_size = int(read(parser, "MySQL").get('batch_size', 500))
 
     db_admin = read(parser, "Databases")['admin']
     db_analysis = read(parser, "Databases")['analysis']
@@ -67,6 +76,8 @@ if (os.path.isfile(config_file)):
 
     # status
     status_check_freq= int(read(parser, "Status")['check_frequency'])
+    progress_rate = float(read(parser, "Status").get('progress_rate', 4))
+    control_refresh = float(read(parser, "Status").get('control_refresh', 1))
 
     # action
     deep = read(parser, "Action")['deep_scan'].lower() == 'true'
@@ -76,9 +87,22 @@ if (os.path.isfile(config_file)):
     # cache
     path_cache_size = int(read(parser, "Cache")['path_cache_size'])
     op_life = int(read(parser, "Cache")['op_life'])
+    asset_cache_size = int(read(parser, "Cache").get('asset_cache_size', 500000))
+    scan_count = int(read(parser, "Cache").get('scan_count', 1000))
+    local_tier = read(parser, "Cache").get('local_tier', 'false').lower() == 'true'
+    local_tier_size = int(read(parser, "Cache").get('local_tier_size', 1024))
+    local_tier_ttl = int(read(parser, "Cache").get('local_tier_ttl', 30))
+    param_flush_interval = float(read(parser, "Cache").get('param_flush_interval', 5))
+    # each process journals to the path with its pid added, see core.journal
+    journal_path = read(parser, "Cache").get('journal', 'ops.journal')
+    journal_flush_interval = float(read(parser, "Cache").get('journal_flush_interval', 1))
+    pattern_refresh = float(read(parser, "Cache").get('pattern_refresh', 60))
 
     # redis
     redis_host = read(parser, "Redis")['host']
+    redis_shared = read(parser, "Redis").get('shared_connection', 'false').lower() == 'true'
+    # redis or memory, the latter keeps cache2 in process for tests and single-process runs
+    redis_backend = read(parser, "Redis").get('backend', 'redis').lower()
 
     initialized = True
     
@@ -18,16 +18,20 @@ from core import var
 
 def _set_field_value(pid, field, value, check_status=False):
 
+    import config
     import ops
     from core import cache2
     import start
 
-    start.initialize_cache2('localhost')
+    # the same stores the process reads its control flags from
+    start.initialize_cache2(config.redis_host, shared=config.redis_shared, backend=config.redis_backend)
 
     key =  cache2.get_key(pid, ops.OPS, ops.EXEC)
     values = cache2.get_hash2(key)
     values[field] = value
     cache2.set_hash2(key, values)
+    # the process refreshes its control flags on this
+    cache2.datastore.publish(ops.control_channel(pid), field)
 
     if check_status:
         ops.check_status()
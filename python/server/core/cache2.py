@@ -1,10 +1,15 @@
 """Cache2 is a wrapper around a subset of Redis, it provides support for complex keys as indexes for redis lists and key groups for other Redis types"""
 
 import os
+import fnmatch
 import logging
+import threading
+import time
+from collections import OrderedDict
 
 import util
 import log
+import memstore
 
 import redis
 
@@ -15,6 +20,9 @@ KEY = 'key'
 DATA = 'data'
 LIST = 'list'
 HASH = 'hashset'
+INDEX = 'index'
+AGE = 'age'
+PARTITIONS = 'partitions'
 DELIM = ':'
 WILDCARD = '*'
 PID = str(os.getpid())
@@ -25,15 +33,448 @@ hashstore = None
 liststore = None
 orderedliststore = None
 
+# the active batch of each thread, if any. see batch()
+_batches = threading.local()
+
+# COUNT hint passed to SCAN when enumerating keys
+scan_count = 1000
+
+# the in-process read-through tier, if enabled. see enable_local_tier()
+local_tier = None
+# the keyspace channels of the keys the local tier holds, and the thread listening to them. see _watch()
+local_tier_pubsub = None
+local_tier_listener = None
+watched = set()
+
+# key_group -> Policy. see set_policy()
+policies = {}
+
 # these compound (key_group + identifier) keys occupy sorted lists, and are used as indexes for other sets of data
 # identifier is an arbitrary list which will be separated by DELIM
 
-# NOTE: in order for complex keys to truly work as indexes, the ordered set of values owned by them need to be used where these keys are currently being used
+# every key_group also owns a sorted set (INDEX:key_group) of its compound keys, all scored 0 so that they are ordered
+# lexicographically. create_key and delete_key maintain it and prefix lookups are answered with ZRANGEBYLEX
+
+# namespaces
+
+class Namespace(object):
+    """presents a key prefix on a single redis connection as though it were a store of its own, so that all of the
+    stores can share one connection pool and have their commands pipelined (or MULTI'd) together"""
+    # commands whose first argument is not a key
+    KEYLESS = ('config_set', 'execute', 'pipeline', 'publish', 'pubsub', 'register_script', 'reset')
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+        self.connection_pool = client.connection_pool
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        if name in Namespace.KEYLESS:
+            return command
+
+        def prefixed(key, *args, **kwargs):
+            return command(self.prefix + key, *args, **kwargs)
+        return prefixed
+
+    def dbsize(self):
+        return sum(1 for key in self.scan_iter())
+
+    def keys(self, pattern=WILDCARD):
+        return list(self.scan_iter(match=pattern))
+
+    def flushdb(self):
+        pipe = self.client.pipeline(transaction=False)
+        for key in self.client.scan_iter(match=self.prefix + WILDCARD, count=scan_count):
+            pipe.delete(key)
+        pipe.execute()
+
+    def on(self, client):
+        """return this namespace on another client, typically a pipeline"""
+        return Namespace(client, self.prefix)
+
+    def scan_iter(self, match=None, count=None):
+        match = WILDCARD if match is None else match
+        for key in self.client.scan_iter(match=self.prefix + match, count=count):
+            yield key[len(self.prefix):]
+
+
+def _connection(store):
+    """return the client that carries store's commands, shared by every namespace on it"""
+    return store.client if isinstance(store, Namespace) else store
+
+
+# batches
+
+class Batch(object):
+    """queues cache2 writes into one pipeline per connection and sends them in a single round trip per connection on
+    flush. reads made while a batch is open go straight to the stores and do not see queued writes.
+
+    nested batches join the outermost one, which alone sends or discards. a nested batch that fails takes back the
+    commands it queued, and one opened with transaction=True makes the pipelines transactions. batches are sent early,
+    every size commands, only between nested batches and never when a transaction was asked for"""
+    def __init__(self, transaction=False, size=1000):
+        self.transaction = transaction
+        self.size = size
+        self.pipes = {}
+        self.queued = 0
+        self.outer = None
+        # nested batches open, and how many of them are transactions
+        self.nested = 0
+        self.transactions = 0
+        # what the outer batch had queued when this one joined it
+        self.mark = None
+
+    def __enter__(self):
+        self.outer = getattr(_batches, 'active', None)
+        if self.outer is None:
+            _batches.active = self
+            return self
+
+        self.mark = self.outer.join(self.transaction)
+        return self.outer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outer is not None:
+            self.outer.leave(self.transaction, self.mark if exc_type is not None else None)
+            return
+
+        _batches.active = None
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def join(self, transaction):
+        """open a nested batch, returning a mark of what was queued before it"""
+        if self.nested == 0 and self._flush_due():
+            self.flush()
+
+        self.nested += 1
+        if transaction:
+            self.transactions += 1
+            for pipe in self.pipes.values():
+                pipe.transaction = True
+        return self.queued, dict((key, len(pipe.command_stack)) for key, pipe in self.pipes.items())
+
+    def leave(self, transaction, mark=None):
+        """close a nested batch, taking back the commands it queued after mark if it failed"""
+        self.nested -= 1
+        if transaction:
+            self.transactions -= 1
+
+        if mark is not None:
+            self.queued, lengths = mark
+            for key in self.pipes.keys():
+                if key in lengths:
+                    del self.pipes[key].command_stack[lengths[key]:]
+                else:
+                    self.pipes.pop(key).reset()
+
+    def discard(self):
+        for pipe in self.pipes.values():
+            pipe.reset()
+        self.pipes.clear()
+        self.queued = 0
+
+    def flush(self):
+        result = []
+        for pipe in self.pipes.values():
+            result.extend(pipe.execute())
+        LOG.debug('Batch.flush() sent %i commands' % self.queued)
+        self.pipes.clear()
+        self.queued = 0
+        return result
+
+    def _flush_due(self):
+        return self.size is not None and not self.transaction and self.transactions == 0 and self.queued >= self.size
+
+    def pipe(self, store):
+        if self.nested == 0 and self._flush_due():
+            self.flush()
+
+        self.queued += 1
+        client = _connection(store)
+        if id(client) not in self.pipes:
+            self.pipes[id(client)] = client.pipeline(transaction=self.transaction or self.transactions > 0)
+        return store.on(self.pipes[id(client)]) if isinstance(store, Namespace) else self.pipes[id(client)]
+
+
+def batch(transaction=False, size=1000):
+    """open a batch: with cache2.batch(): ... Nested batches join the outermost one, which flushes on exit"""
+    return Batch(transaction=transaction, size=size)
+
+
+def _writer(store):
+    """return the active batch's pipeline for store, or store itself when no batch is open"""
+    active = getattr(_batches, 'active', None)
+    return store if active is None else active.pipe(store)
+
+
+# policies
+
+class Policy(object):
+    """expiry (ttl, in seconds) and size budget (limit, in keys) for the compound keys of a key group. budgets are
+    kept per partition, the first depth segments of the key name, e.g. depth=2 budgets ops keys per pid. with
+    count_fields, limit counts the fields of the keys' hashes instead, for groups that keep many values in a few keys"""
+    def __init__(self, ttl=None, limit=None, depth=1, count_fields=False):
+        self.ttl = ttl
+        self.limit = limit
+        self.depth = depth
+        self.count_fields = count_fields
+        self.created = 0
+        # budgets are enforced every check_every keys created rather than on every create_key
+        self.check_every = 100 if limit is None else max(1, min(100, limit // 10))
+        # the partitions this process has registered, see partitions_name()
+        self.partitions = set()
+
+
+def set_policy(key_group, ttl=None, limit=None, depth=1, count_fields=False):
+    """declare the expiry and size budget applied to key_group's keys by create_key, set_hash2 and add_item(s)2"""
+    policies[key_group] = Policy(ttl=ttl, limit=limit, depth=depth, count_fields=count_fields)
+
+
+def age_name(key, policy):
+    """get the name of the sorted set recording the creation time of the keys in key's budget partition"""
+    return DELIM.join([AGE] + key.split(DELIM)[:policy.depth])
+
+
+def partitions_name(key_group):
+    """get the name of the set of key_group's age sets, so that partitions no process writes to anymore (those of
+    exited pids) are still trimmed"""
+    return DELIM.join([PARTITIONS, key_group])
+
+
+def _policy(key):
+    return policies.get(key.split(DELIM)[0])
+
+
+def _expire(store, name, key):
+    """queue the key group's ttl, if any, for name, a value owned by the compound key key"""
+    policy = _policy(key)
+    if policy is not None and policy.ttl is not None:
+        _writer(store).expire(name, policy.ttl)
+
+
+def enforce_policy(key):
+    """trim key's budget partition: forget keys that have expired, in every partition of the group, and delete the
+    oldest keys over the limit. returns the keys evicted"""
+    policy = _policy(key)
+    if policy is None:
+        return []
+
+    age = age_name(key, policy)
+    if policy.ttl is not None:
+        # keys expire by themselves, their entries in the index and in every partition's age set are removed here
+        key_group = key.split(DELIM)[0]
+        for partition in keystore.smembers(partitions_name(key_group)) | set([age]):
+            expired = keystore.zrangebyscore(partition, 0, time.time() - policy.ttl)
+            with batch():
+                for member in expired:
+                    _writer(keystore).zrem(index_name(member), member)
+                    _writer(keystore).zrem(partition, member)
+                if len(expired) > 0 and partition != age and keystore.zcard(partition) == len(expired):
+                    _writer(keystore).srem(partitions_name(key_group), partition)
+
+    if policy.limit is not None:
+        evict = _over_field_limit(age, policy.limit) if policy.count_fields else _over_key_limit(age, policy.limit)
+        if len(evict) > 0:
+            LOG.debug('enforce_policy(key=%s) evicting %i keys' % (key, len(evict)))
+            with batch():
+                for member in evict:
+                    delete_key(member)
+        return evict
+
+    return []
+
+
+def _over_key_limit(age, limit):
+    """the oldest keys in the partition age beyond limit keys"""
+    excess = keystore.zcard(age) - limit
+    return keystore.zrange(age, 0, excess - 1) if excess > 0 else []
+
+
+def _over_field_limit(age, limit):
+    """the oldest keys in the partition age whose hashes hold the fields beyond limit. the newest key is kept, however
+    many fields it has"""
+    members = keystore.zrange(age, 0, -1)
+    pipe = _connection(hashstore).pipeline(transaction=False)
+    store = hashstore.on(pipe) if isinstance(hashstore, Namespace) else pipe
+    for member in members:
+        store.hlen(DELIM.join([HASH, member]))
+    sizes = pipe.execute()
+    result = []
+    total = sum(sizes)
+    for member, size in zip(members[:-1], sizes):
+        if total <= limit:
+            break
+        result.append(member)
+        total -= size
+    return result
+
+
+# scripts
+# server-side Lua for compound operations, run with EVALSHA so that each is one atomic round trip
+
+# reserve the next member of a set of numbered names: KEYS[1] is the set, ARGV[1] the name prefix. returns the number
+RESERVE_MEMBER = """
+local count = redis.call('SCARD', KEYS[1])
+redis.call('SADD', KEYS[1], ARGV[1] .. ':' .. count)
+return count
+"""
+
+# HGETALL each of KEYS, returned as a list of flat field/value lists
+GET_HASHES = """
+local result = {}
+for index, key in ipairs(KEYS) do
+    result[index] = redis.call('HGETALL', key)
+end
+return result
+"""
+
+
+# python equivalents of the scripts above, for memstore.MemoryStore
+
+def _reserve_member(client, keys, args):
+    count = client.scard(keys[0])
+    client.sadd(keys[0], '%s:%i' % (args[0], count))
+    return count
+
+
+def _get_hashes(client, keys, args):
+    return [[item for field, value in client.hgetall(key).items() for item in (field, value)] for key in keys]
+
+
+memstore.emulate(RESERVE_MEMBER, _reserve_member)
+memstore.emulate(GET_HASHES, _get_hashes)
+
+_scripts = {}
+
+def run_script(store, source, keys=[], args=[]):
+    """run a Lua script against store, registering it on first use"""
+    client = _connection(store)
+    if (id(client), source) not in _scripts:
+        _scripts[(id(client), source)] = client.register_script(source)
+
+    prefix = store.prefix if isinstance(store, Namespace) else ''
+    return _scripts[(id(client), source)](keys=[prefix + key for key in keys], args=args)
+
+
+# local tier
+
+class LocalTier(object):
+    """an in-process LRU copy of reads made with local=True. entries expire after ttl seconds and are evicted
+    early when this process writes them or, if keyspace notifications are available, when any process does"""
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, slot):
+        with self.lock:
+            entry = self.entries.pop(slot, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            # re-insert to mark the entry as most recently used
+            self.entries[slot] = entry
+            return entry[1]
+
+    def invalidate(self, slot):
+        with self.lock:
+            self.entries.pop(slot, None)
+
+    def put(self, slot, value):
+        with self.lock:
+            self.entries.pop(slot, None)
+            self.entries[slot] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def _db(store):
+    return store.connection_pool.connection_kwargs.get('db', 0)
+
+
+def _slot(store, name):
+    """identify name in store by its logical database and its actual redis key"""
+    return (_db(store), store.prefix + name if isinstance(store, Namespace) else name)
+
+
+def _invalidate(store, name):
+    if local_tier is not None:
+        local_tier.invalidate(_slot(store, name))
+
+
+def _read_through(store, name, read, copy):
+    if local_tier is None:
+        return read(name)
+
+    slot = _slot(store, name)
+    result = local_tier.get(slot)
+    if result is None:
+        result = read(name)
+        local_tier.put(slot, result)
+        _watch(slot)
+    return copy(result)
+
+
+def _watch(slot):
+    """subscribe to the keyspace channel of the key at slot, so that writes to it by other processes evict it. only the
+    keys read with local=True are subscribed to, a few reference data keys, not the databases they are in"""
+    global local_tier_listener
+    if local_tier_pubsub is None or slot in watched:
+        return
+
+    watched.add(slot)
+    try:
+        local_tier_pubsub.subscribe('__keyspace@%i__:%s' % slot)
+        if local_tier_listener is None:
+            local_tier_listener = threading.Thread(target=_listen_for_invalidations, args=(local_tier_pubsub,),
+                                                   name='cache2-local-tier')
+            local_tier_listener.daemon = True
+            local_tier_listener.start()
+    except redis.RedisError, err:
+        ERR.warning('unable to watch %s, it will expire from the local tier after %i seconds: %s' %
+                    (slot[1], local_tier.ttl, err.message))
+
+
+def _listen_for_invalidations(pubsub):
+    for message in pubsub.listen():
+        if message['type'] == 'message' and local_tier is not None:
+            # channel is __keyspace@<db>__:<name>
+            prefix, name = message['channel'].split('__:', 1)
+            local_tier.invalidate((int(prefix.split('@')[1]), name))
+
+
+def enable_local_tier(size=1024, ttl=30, notify=True):
+    """serve reads made with local=True from process memory. with notify, entries written by other processes are
+    evicted through Redis keyspace notifications, if the server sends them: notify-keyspace-events must include K and
+    the types cached (Kghsx), which is left to the server's configuration. otherwise ttl bounds staleness"""
+    global local_tier, local_tier_pubsub
+    local_tier = LocalTier(size=size, ttl=ttl)
+    if notify and local_tier_pubsub is None:
+        local_tier_pubsub = hashstore.pubsub(ignore_subscribe_messages=True)
+
+
+def disable_local_tier():
+    global local_tier
+    local_tier = None
+
 
 def str_clean4key(input):
     return util.str_clean4comp(input, DELIM, WILDCARD, '-', '_', '.')
 
 
+def index_name(key):
+    """get the name of the sorted set indexing the key group that key (or key group) belongs to"""
+    return DELIM.join([INDEX, key.split(DELIM)[0]])
+
+
 def key_name(key_group, *identifier):
     """get a compound key name for a given identifier and a specified record type"""
     keyname = DELIM.join([key_group, identifier]) if isinstance(identifier, basestring) or isinstance(identifier, unicode) \
@@ -47,11 +488,26 @@ def key_name(key_group, *identifier):
 def create_key(key_group, *identifier, **values):
     """create a new compound key"""
     key = key_name(key_group, *identifier)   
-    result = keystore.rpush(key, None)
-
-    for name in values:
-        val = values[name]
-        orderedliststore.rpush(key, val)
+    with batch(transaction=True):
+        result = _writer(keystore).rpush(key, None)
+        _writer(keystore).zadd(index_name(key), key, 0)
+        _expire(keystore, key, key)
+
+        if len(values) > 0:
+            _writer(orderedliststore).rpush(key, *values.values())
+            _expire(orderedliststore, key, key)
+
+        policy = _policy(key)
+        if policy is not None:
+            age = age_name(key, policy)
+            _writer(keystore).zadd(age, key, time.time())
+            if age not in policy.partitions:
+                _writer(keystore).sadd(partitions_name(key.split(DELIM)[0]), age)
+                policy.partitions.add(age)
+            policy.created += 1
+
+    if policy is not None and policy.created % policy.check_every == 0:
+        enforce_policy(key)
 
     LOG.debug('create_key(key_group=%s, identifier=%s) returns %s' % (key, identifier, result))
     return key
@@ -59,58 +515,106 @@ def create_key(key_group, *identifier, **values):
 
 # def delete_key(key, delete_list=False, delete_hash=False):
 def delete_key(key):
-    result = keystore.delete(key)
-   
-    # remove hash values for key (delete_hash2)
-    identifier = DELIM.join([HASH, key])
-    hkeys = hashstore.hkeys(identifier)
-    for hkey in hkeys:
-        hashstore.hdel(identifier, hkey)
-
-    # remove list values for key (clear_items2)
-    identifier = DELIM.join([LIST, key])
-    values = liststore.smembers(identifier)
-    for value in values:
-        result = liststore.srem(identifier, value)
-
-    while lpeek2(key):
-        lpop2(key)
-
-    while rpeek2(key):
-        rpop2(key)
+    with batch(transaction=True):
+        result = _writer(keystore).delete(key)
+        _writer(keystore).zrem(index_name(key), key)
+        if _policy(key) is not None:
+            _writer(keystore).zrem(age_name(key, _policy(key)), key)
+       
+        # remove hash values for key (delete_hash2)
+        _writer(hashstore).delete(DELIM.join([HASH, key]))
+        _invalidate(hashstore, DELIM.join([HASH, key]))
+
+        # remove list values for key (clear_items2)
+        _writer(liststore).delete(DELIM.join([LIST, key]))
+        _invalidate(liststore, DELIM.join([LIST, key]))
+
+        # remove ordered list values for key
+        _writer(orderedliststore).delete(key)
 
     LOG.debug('datastore.delete(key=%s) returns: %s' % (key, str(result)))
 
 
 def delete_key_group(key_group):
     LOG.debug('delete_key_group(key_group=%s)' % key_group)
-    search = key_group + WILDCARD
-    for key in keystore.keys(search):
-        delete_key(key)
+    with batch():
+        for key in iter_keys(key_group):
+            delete_key(key)
+        _writer(keystore).delete(index_name(key_group))
+        for partition in keystore.smembers(partitions_name(key_group)):
+            _writer(keystore).delete(partition)
+        _writer(keystore).delete(partitions_name(key_group))
+    if key_group in policies:
+        policies[key_group].partitions.clear()
 
 
 def delete_keys(key_group, *identifier):
-    for key in get_keys(key_group, *identifier):
-        delete_key(key)
+    with batch():
+        for key in get_keys(key_group, *identifier):
+            delete_key(key)
 
 
 def get_key(key_group, *identifier):
-    result = get_keys(key_group, *identifier)
-    LOG.debug('get_keys(key_group=%s, identifier=%s) returns %s' % (key_group, identifier, result))
-    if len(result) is 1:
-        return result[0]
+    key = key_name(key_group, *identifier)
+    if keystore.exists(key):
+        LOG.debug('get_key(key_group=%s, identifier=%s) returns %s' % (key_group, identifier, key))
+        return key
     # (else)
     return create_key(key_group, *identifier)
 
 
 def get_keys(key_group, *identifier):
-    search = key_group + WILDCARD if identifier is () else key_name(key_group, *identifier) + WILDCARD
-    result = keystore.keys(str_clean4key(search))
-    # result = config.datastore.scan(str_clean4key(search), 0, -1)
+    result = list(iter_keys(key_group, *identifier))
     LOG.debug('get_keys(key_group=%s, identifier=%s) returns %s' % (key_group, identifier, result))
     return result
 
 
+def iter_keys(key_group, *identifier):
+    """generate the compound keys matching key_group + identifier, in order, from the key group's index"""
+    search = key_group if identifier is () else key_name(key_group, *identifier)
+    search = str_clean4key(search)
+
+    # identifiers may contain wildcards, the index can only narrow the search to the literal prefix before the first one
+    # (cleaned key names are ascii, str() keeps the range bounds below from being promoted to unicode)
+    prefix = str(search.split(WILDCARD)[0])
+    pattern = search + WILDCARD if WILDCARD in search else None
+
+    for key in range_keys(index_name(search), prefix):
+        if pattern is None or fnmatch.fnmatchcase(key, pattern):
+            yield key
+
+
+def range_keys(index, prefix, count=None):
+    """generate the members of index that start with prefix, reading count members per round trip.
+    each page starts after the last member read, so callers may delete keys as they go"""
+    count = scan_count if count is None else count
+    lower = '[' + prefix
+    while True:
+        keys = keystore.zrangebylex(index, lower, '[' + prefix + '\xff', start=0, num=count)
+        for key in keys:
+            yield key
+        if len(keys) < count:
+            break
+        lower = '(' + keys[-1]
+
+
+def build_indexes():
+    """index compound keys that were created without one, e.g. by a process running an older cache2"""
+    with batch():
+        for key in scan_keys(WILDCARD):
+            if not key.startswith(INDEX + DELIM) and not key.startswith(AGE + DELIM) and \
+                    not key.startswith(PARTITIONS + DELIM):
+                _writer(keystore).zadd(index_name(key), key, 0)
+
+
+def scan_keys(pattern, store=None, count=None):
+    """generate the names matching pattern in store (the key store by default), using SCAN rather than KEYS"""
+    store = keystore if store is None else store
+    count = scan_count if count is None else count
+    for key in store.scan_iter(match=pattern, count=count):
+        yield key
+
+
 def key_exists(key_group, *identifier):
      key = key_name(key_group, *identifier)
      return keystore.exists(key)
@@ -150,8 +654,8 @@ def lpop2(key):
 
 
 def lpush(key, *values):
-    for val in values:
-        orderedliststore.lpush(key, val)
+    if len(values) > 0:
+        _writer(orderedliststore).lpush(key, *values)
 
 
 def rpeek(key_group, *identifier):
@@ -181,24 +685,22 @@ def rpop2(key):
 
 
 def rpush(key, *values):
-    for val in values:
-        orderedliststore.rpush(key, val)
+    if len(values) > 0:
+        _writer(orderedliststore).rpush(key, *values)
 
 
 # hashsets
 
 def delete_hash(key_group, identifier):
     key = DELIM.join([HASH, key_group, identifier])
-    hkeys = hashstore.hkeys(key)
-    for hkey in hkeys:
-        hashstore.hdel(key, hkey)
+    _writer(hashstore).delete(key)
+    _invalidate(hashstore, key)
 
 
 def delete_hash2(key):
     identifier = DELIM.join([HASH, key])
-    hkeys = hashstore.hkeys(identifier)
-    for hkey in hkeys:
-        hashstore.hdel(identifier, hkey)
+    _writer(hashstore).delete(identifier)
+    _invalidate(hashstore, identifier)
 
 
 def get_hash(key_group, identifier):
@@ -208,17 +710,59 @@ def get_hash(key_group, identifier):
     return result
 
 
-def get_hash2(key):
+def get_hash_value2(key, field):
+    return hashstore.hget(DELIM.join([HASH, key]), field)
+
+
+def get_hash_values2(key, fields):
+    """HMGET fields, returning their values (None where missing) in the order of fields"""
+    if len(fields) == 0:
+        return []
+    return hashstore.hmget(DELIM.join([HASH, key]), fields)
+
+
+def delete_hash_value2(key, field):
+    identifier = DELIM.join([HASH, key])
+    _writer(hashstore).hdel(identifier, field)
+    _invalidate(hashstore, identifier)
+
+
+def increment_hash_value2(key, field, amount=1):
+    """HINCRBY field, returning its new value. not batched, the caller needs the result"""
+    identifier = DELIM.join([HASH, key])
+    result = hashstore.hincrby(identifier, field, amount)
+    _expire(hashstore, identifier, key)
+    _invalidate(hashstore, identifier)
+    return result
+
+
+def set_hash_value2(key, field, value):
+    identifier = DELIM.join([HASH, key])
+    _writer(hashstore).hset(identifier, field, value)
+    _expire(hashstore, identifier, key)
+    _invalidate(hashstore, identifier)
+
+
+def get_hash2(key, local=False):
     identifier = DELIM.join([HASH, key])
-    result = hashstore.hgetall(identifier)
+    result = _read_through(hashstore, identifier, hashstore.hgetall, dict) if local else hashstore.hgetall(identifier)
     LOG.debug('get_hash2(key=%s) returns %s' % (key, result))
     return result
 
 
+def get_hashes2(keys):
+    """HGETALL the hashes of keys in one round trip, returning a list of dicts in the order of keys"""
+    pipe = _connection(hashstore).pipeline(transaction=False)
+    store = hashstore.on(pipe) if isinstance(hashstore, Namespace) else pipe
+    for key in keys:
+        store.hgetall(DELIM.join([HASH, key]))
+    return pipe.execute()
+
+
 def get_hashes(key_group, *identifier):
     result = ()
     if identifier is ():
-        for key in get_keys(DELIM.join([HASH, key_group])):
+        for key in scan_keys(DELIM.join([HASH, key_group]) + WILDCARD, store=hashstore):
             ahash = hashstore.hgetall(key)
             if ahash is not None:
                 result += (ahash,)
@@ -236,28 +780,45 @@ def get_hashes(key_group, *identifier):
 def set_hash(key_group, identifier, values):
     key = DELIM.join([HASH, key_group, identifier])
     if len(values) > 0:
-        result = hashstore.hmset(key, values)
+        result = _writer(hashstore).hmset(key, values)
+        _invalidate(hashstore, key)
         LOG.debug('set_hash(key_group=%s, identifier=%s, values=%s) returns: %s' % (key_group, identifier, values, str(result)))
 
 
 def set_hash2(key, values):
     identifier = DELIM.join([HASH, key])
-    delete_hash2(key)
+    with batch(transaction=True):
+        delete_hash2(key)
+        if len(values) > 0:
+            result = _writer(hashstore).hmset(identifier, values)
+            _expire(hashstore, identifier, key)
+            _invalidate(hashstore, identifier)
+            LOG.debug('set_hash2(key=%s, values=%s) returns: %s' % (key, values, str(result)))
+
+
+def update_hash2(key, values):
+    """HMSET values into the hash, leaving its other fields alone"""
+    identifier = DELIM.join([HASH, key])
     if len(values) > 0:
-        result = hashstore.hmset(identifier, values)
-        LOG.debug('set_hash2(key=%s, values=%s) returns: %s' % (key, values, str(result)))
+        _writer(hashstore).hmset(identifier, values)
+        _expire(hashstore, identifier, key)
+        _invalidate(hashstore, identifier)
 
 # lists
 
 def add_item(key_group, identifier, item):
     key = DELIM.join([LIST, key_group, identifier])
-    result = liststore.sadd(key, item)
+    result = _writer(liststore).sadd(key, item)
+    _invalidate(liststore, key)
     LOG.debug('add_item(key_group=%s, identifier=%s, item=%s) returns: %s' % (key_group, identifier, item, str(result)))
 
 
 def add_item2(key, item):
+    owner = key
     key = DELIM.join([LIST, key])
-    result = liststore.sadd(key, item)
+    result = _writer(liststore).sadd(key, item)
+    _expire(liststore, key, owner)
+    _invalidate(liststore, key)
     LOG.debug('add_item(key=%s,item=%s) returns: %s' % (key, item, str(result)))
 
 
@@ -270,38 +831,39 @@ def add_items(key_group, identifier, items):
 
 
 def add_items2(key, items):
+    owner = key
     key = DELIM.join([LIST, key])
-    for item in items:
-        result = liststore.sadd(key, item)
-        LOG.debug('add_item2(key=%s, item=%s) returns: %s' % (key, item, str(result)))
+    if len(items) > 0:
+        result = _writer(liststore).sadd(key, *items)
+        _expire(liststore, key, owner)
+        _invalidate(liststore, key)
+        LOG.debug('add_items2(key=%s, items=%s) returns: %s' % (key, items, str(result)))
 
 
 def clear_items(key_group, identifier):
     key = DELIM.join([LIST, key_group, identifier])
-    values = liststore.smembers(key)
-    for value in values:
-        result = liststore.srem(key, value)
-        LOG.debug('datastore.srem(key_group=%s, identifier=%s) returns: %s' % (key, value, str(result)))
+    result = _writer(liststore).delete(key)
+    _invalidate(liststore, key)
+    LOG.debug('clear_items(key_group=%s, identifier=%s) returns: %s' % (key_group, identifier, str(result)))
 
 
 def clear_items2(key):
     key = DELIM.join([LIST, key])
-    values = liststore.smembers(key)
-    for value in values:
-        result = liststore.srem(key, value)
-        LOG.debug('datastore.srem(key_group=%s, identifier=%s) returns: %s' % (key, value, str(result)))
+    result = _writer(liststore).delete(key)
+    _invalidate(liststore, key)
+    LOG.debug('clear_items2(key=%s) returns: %s' % (key, str(result)))
 
 
-def get_items(key_group, identifier):
+def get_items(key_group, identifier, local=False):
     key = DELIM.join([LIST, key_group, identifier])
-    result = liststore.smembers(key)
+    result = _read_through(liststore, key, liststore.smembers, set) if local else liststore.smembers(key)
     LOG.debug('get_items(key_group=%s, identifier=%s) returns: %s' % (key_group, identifier, str(result)))
     return result
 
 
-def get_items2(key):
+def get_items2(key, local=False):
     key = DELIM.join([LIST, key])
-    result = liststore.smembers(key)
+    result = _read_through(liststore, key, liststore.smembers, set) if local else liststore.smembers(key)
     LOG.debug('get_items(key=%s) returns: %s' % (key, str(result)))
     return result
 
@@ -315,47 +877,56 @@ def add_hashset(keyname, set_identifier, hashset):
     key = get_key(keyname, set_identifier)
     hlkey = DELIM.join([LIST, HASH, key])
 
-    count = len(get_items2(hlkey))
+    # the index is reserved server-side so that concurrent writers never share one
+    count = run_script(liststore, RESERVE_MEMBER, keys=[DELIM.join([LIST, hlkey])], args=[key])
+    _invalidate(liststore, DELIM.join([LIST, hlkey]))
     keyinlist = DELIM.join([key, str(count)])
 
     set_hash2(keyinlist, hashset)
-    add_item2(hlkey, keyinlist)
 
 
 def clear_hashsets(keyname, set_identifier):
     key = get_key(keyname, set_identifier)
     hlkey = DELIM.join([LIST, HASH, key])
 
-    count = len(get_items2(hlkey))
-    for index in range(count):
-        keyinlist = DELIM.join([key, str(index)])
-        delete_hash2(keyinlist)
+    count = liststore.scard(DELIM.join([LIST, hlkey]))
+    with batch():
+        for index in range(count):
+            keyinlist = DELIM.join([key, str(index)])
+            delete_hash2(keyinlist)
 
-    clear_items2(hlkey)
+        clear_items2(hlkey)
 
 
 def get_hashsets(keyname, set_identifier):
-    result = []
-
     key = get_key(keyname, set_identifier)
     hlkey = DELIM.join([LIST, HASH, key])
-    count = len(get_items2(hlkey))
-
-    for index in range(count):
-        keyinlist = DELIM.join([key, str(index)])
-        ahash = get_hash2(keyinlist)
-        result.append(ahash)
+    count = liststore.scard(DELIM.join([LIST, hlkey]))
+    if count == 0:
+        return []
 
-    return result
+    keys = [DELIM.join([HASH, key, str(index)]) for index in range(count)]
+    hashes = run_script(hashstore, GET_HASHES, keys=keys)
+    return [dict(zip(ahash[::2], ahash[1::2])) for ahash in hashes]
 
 
 # utility
 
 def flush_all():
     LOG.info('flushing redis database')
+    for policy in policies.values():
+        policy.partitions.clear()
     keystore.flushdb()
+    flush_values()
+
+
+def flush_values():
+    """flush every store but the keystore, compound keys remain. the local tier is cleared with them, it would
+    otherwise go on serving what was flushed"""
     datastore.flushdb()
     hashstore.flushdb()
     liststore.flushdb()
     orderedliststore.flushdb()
+    if local_tier is not None:
+        local_tier.clear()
     
\ No newline at end of file
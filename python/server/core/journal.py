@@ -0,0 +1,119 @@
+"""Journal is an append-only file of json entries, one per line. An entry is on disk once append() returns, so
+entries that were appended but never applied elsewhere can be replayed after a crash. take() hands out the entries
+waiting to be applied and done() drops them from disk once they have been.
+
+Given a pid, a journal belongs to one process: it is kept under a name with the pid in it, locked while the process
+runs. The journals of processes that have exited, the only ones whose locks can be taken, are adopted when it opens"""
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+
+import log
+
+LOG = log.get_safe_log(__name__, logging.INFO)
+ERR = log.get_safe_log('errors', logging.WARNING)
+
+
+def lock(path):
+    """an exclusive lock on path, or None if another process holds it. the lock lasts until the file is closed"""
+    file = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return file
+    except IOError:
+        file.close()
+        return None
+
+
+class Journal(object):
+    def __init__(self, path, pid=None):
+        root, ext = os.path.splitext(path)
+        self.path = path if pid is None else '%s.%s%s' % (root, pid, ext)
+        # entries taken but not yet done() are kept here, so a failed apply can be retried
+        self.taken_path = self.path + '.taken'
+        self.lock = threading.Lock()
+        self.lock_file = lock(self.path)
+        if self.lock_file is None:
+            raise IOError('journal %s is in use by another process' % self.path)
+
+        self.pending = self.replay(self.path)
+        self.file = open(self.path, 'a')
+        if pid is not None:
+            # path itself is where journals were kept before they were per process
+            for other in [path] + sorted(glob.glob('%s.*%s' % (root, ext))):
+                if other != self.path:
+                    self.adopt(other)
+
+        if len(self.pending) > 0:
+            LOG.info('replaying %i journal entries from %s' % (len(self.pending), self.path))
+
+    def replay(self, path):
+        entries = []
+        for path in (path + '.taken', path):
+            if os.path.isfile(path):
+                with open(path) as file:
+                    for line in file:
+                        try:
+                            entries.append(json.loads(line))
+                        except ValueError:
+                            # the tail of an append interrupted by a crash
+                            ERR.warning('skipping unreadable journal entry in %s' % path)
+        return entries
+
+    def adopt(self, path):
+        """take over the entries of the journal at path, unless the process it belongs to is still running"""
+        other = lock(path)
+        if other is None:
+            return
+
+        try:
+            entries = self.replay(path)
+            if len(entries) > 0:
+                LOG.info('adopting %i journal entries from %s' % (len(entries), path))
+                for entry in entries:
+                    self.file.write(json.dumps(entry) + '\n')
+                self.file.flush()
+                self.pending.extend(entries)
+
+            for name in (path + '.taken', path, path + '.lock'):
+                if os.path.isfile(name):
+                    os.remove(name)
+        finally:
+            other.close()
+
+    def append(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.pending.append(entry)
+
+    def take(self):
+        """return the entries waiting to be applied, follow with done() once they are, or restore() if they are not"""
+        with self.lock:
+            entries, self.pending = self.pending, []
+            if len(entries) == 0:
+                return entries
+
+            self.file.close()
+            if os.path.isfile(self.taken_path):
+                # still holds entries from a take() that failed
+                with open(self.taken_path, 'a') as taken, open(self.path) as file:
+                    taken.write(file.read())
+                os.remove(self.path)
+            else:
+                os.rename(self.path, self.taken_path)
+            self.file = open(self.path, 'a')
+            return entries
+
+    def done(self):
+        with self.lock:
+            if os.path.isfile(self.taken_path):
+                os.remove(self.taken_path)
+
+    def restore(self, entries):
+        with self.lock:
+            self.pending = entries + self.pending
@@ -0,0 +1,409 @@
+"""MemoryStore is a pure-Python stand-in for the subset of the redis client used by cache2. It keeps its data in
+dicts (and sorted lists for sorted sets) within the process, so single-process runs, tests and benchmarks can use
+cache2 without a Redis server"""
+
+import bisect
+import fnmatch
+import threading
+import time
+
+import redis
+
+from util import encode
+
+# Lua source -> python function(client, keys, args), see emulate()
+EMULATIONS = {}
+
+def emulate(source, function):
+    """register a python equivalent for a Lua script, MemoryStore cannot evaluate Lua"""
+    EMULATIONS[source] = function
+
+
+class ConnectionPool(object):
+    def __init__(self, db):
+        self.connection_kwargs = {'db': db}
+
+
+class Script(object):
+    def __init__(self, store, source):
+        if source not in EMULATIONS:
+            raise redis.RedisError('MemoryStore has no emulation for this script')
+        self.store = store
+        self.source = source
+
+    def __call__(self, keys=[], args=[], client=None):
+        return EMULATIONS[self.source](self.store if client is None else client, keys, args)
+
+
+class Top(object):
+    """compares above every member, so (score, TOP) sorts after every entry with that score"""
+    def __eq__(self, other):
+        return False
+
+    def __ne__(self, other):
+        return True
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+TOP = Top()
+
+
+class SortedSet(object):
+    """members ordered by (score, member), as redis orders them. order stays sorted, so ranges are found by bisection"""
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        added = member not in self.scores
+        if not added:
+            self._discard(self.scores[member], member)
+        self.scores[member] = score
+        bisect.insort(self.order, (score, member))
+        return added
+
+    def remove(self, member):
+        if member not in self.scores:
+            return False
+        self._discard(self.scores.pop(member), member)
+        return True
+
+    def _discard(self, score, member):
+        del self.order[bisect.bisect_left(self.order, (score, member))]
+
+
+def _lex_index(order, value, lower):
+    """the index in order at which a ZRANGEBYLEX bound falls. members are ordered by value only when they share a
+    score, which redis requires of lex ranges"""
+    if value == '-':
+        return 0
+    if value == '+' or len(order) == 0:
+        return len(order)
+    inclusive, entry = value[0] == '[', (order[0][0], encode(value[1:]))
+    if lower == inclusive:
+        return bisect.bisect_left(order, entry)
+    return bisect.bisect_right(order, entry)
+
+
+def _score_index(order, value, lower):
+    """the index in order at which a ZRANGEBYSCORE bound falls"""
+    exclusive = isinstance(value, basestring) and value.startswith('(')
+    score = float(value[1:] if exclusive else value)
+    if lower != exclusive:
+        return bisect.bisect_left(order, (score,))
+    return bisect.bisect_right(order, (score, TOP))
+
+
+def _range(order, first, last, start, num):
+    """order[first:last], paged by start and num as the ZRANGEBY* LIMIT option does"""
+    if start is not None and num is not None:
+        first += start
+        last = last if num < 0 else min(last, first + num)
+    return order[first:last]
+
+
+class MemoryStore(object):
+    def __init__(self, db=0):
+        self.connection_pool = ConnectionPool(db)
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.RLock()
+
+    # keys
+
+    def _get(self, name, kind=None, create=False):
+        name = encode(name)
+        if name in self.expires and self.expires[name] <= time.time():
+            del self.expires[name]
+            self.data.pop(name, None)
+
+        if name not in self.data:
+            if not create:
+                return None
+            self.data[name] = kind()
+
+        value = self.data[name]
+        if kind is not None and not isinstance(value, kind):
+            raise redis.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _prune(self, name):
+        """redis removes aggregate values once they are empty"""
+        name = encode(name)
+        if name in self.data and len(self.data[name]) == 0:
+            del self.data[name]
+            self.expires.pop(name, None)
+
+    def delete(self, *names):
+        with self.lock:
+            count = 0
+            for name in names:
+                if self._get(name) is not None:
+                    del self.data[encode(name)]
+                    self.expires.pop(encode(name), None)
+                    count += 1
+            return count
+
+    def exists(self, name):
+        with self.lock:
+            return self._get(name) is not None
+
+    def expire(self, name, seconds):
+        with self.lock:
+            if self._get(name) is None:
+                return False
+            self.expires[encode(name)] = time.time() + seconds
+            return True
+
+    def ttl(self, name):
+        with self.lock:
+            if self._get(name) is None or encode(name) not in self.expires:
+                return None
+            return int(round(self.expires[encode(name)] - time.time()))
+
+    def type(self, name):
+        with self.lock:
+            value = self._get(name)
+            if value is None:
+                return 'none'
+            return {list: 'list', dict: 'hash', set: 'set', SortedSet: 'zset'}[value.__class__]
+
+    def keys(self, pattern='*'):
+        return list(self.scan_iter(match=pattern))
+
+    def scan_iter(self, match=None, count=None):
+        with self.lock:
+            names = [name for name in self.data.keys() if self._get(name) is not None]
+        for name in names:
+            if match is None or fnmatch.fnmatchcase(name, match):
+                yield name
+
+    def dbsize(self):
+        return len(self.keys())
+
+    def flushdb(self):
+        with self.lock:
+            self.data.clear()
+            self.expires.clear()
+            return True
+
+    # lists
+
+    def llen(self, name):
+        with self.lock:
+            value = self._get(name, list)
+            return 0 if value is None else len(value)
+
+    def lpush(self, name, *values):
+        with self.lock:
+            value = self._get(name, list, create=True)
+            for item in values:
+                value.insert(0, encode(item))
+            return len(value)
+
+    def rpush(self, name, *values):
+        with self.lock:
+            value = self._get(name, list, create=True)
+            value.extend([encode(item) for item in values])
+            return len(value)
+
+    def lpop(self, name):
+        with self.lock:
+            value = self._get(name, list)
+            if value:
+                result = value.pop(0)
+                self._prune(name)
+                return result
+
+    def rpop(self, name):
+        with self.lock:
+            value = self._get(name, list)
+            if value:
+                result = value.pop()
+                self._prune(name)
+                return result
+
+    def lrange(self, name, start, end):
+        with self.lock:
+            value = self._get(name, list) or []
+            end = len(value) if end == -1 else end + 1
+            return value[start:end] if end != 0 else value[start:]
+
+    # hashes
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            value = self._get(name, dict)
+            if value is None:
+                return 0
+            count = len([value.pop(encode(key)) for key in keys if encode(key) in value])
+            self._prune(name)
+            return count
+
+    def hget(self, name, key):
+        with self.lock:
+            value = self._get(name, dict)
+            return None if value is None else value.get(encode(key))
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self._get(name, dict) or {})
+
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            value = self._get(name, dict, create=True)
+            value[encode(key)] = encode(int(value.get(encode(key), 0)) + amount)
+            return int(value[encode(key)])
+
+    def hkeys(self, name):
+        with self.lock:
+            return list((self._get(name, dict) or {}).keys())
+
+    def hlen(self, name):
+        with self.lock:
+            return len(self._get(name, dict) or ())
+
+    def hmget(self, name, keys, *args):
+        with self.lock:
+            value = self._get(name, dict) or {}
+            keys = [keys] if isinstance(keys, basestring) else list(keys)
+            return [value.get(encode(key)) for key in keys + list(args)]
+
+    def hmset(self, name, mapping):
+        with self.lock:
+            value = self._get(name, dict, create=True)
+            for key in mapping:
+                value[encode(key)] = encode(mapping[key])
+            return True
+
+    def hset(self, name, key, item):
+        with self.lock:
+            value = self._get(name, dict, create=True)
+            added = encode(key) not in value
+            value[encode(key)] = encode(item)
+            return 1 if added else 0
+
+    # sets
+
+    def sadd(self, name, *values):
+        with self.lock:
+            value = self._get(name, set, create=True)
+            count = len(value)
+            value.update([encode(item) for item in values])
+            return len(value) - count
+
+    def scard(self, name):
+        with self.lock:
+            return len(self._get(name, set) or ())
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self._get(name, set) or ())
+
+    def srem(self, name, *values):
+        with self.lock:
+            value = self._get(name, set)
+            if value is None:
+                return 0
+            count = len(value)
+            value.difference_update([encode(item) for item in values])
+            count -= len(value)
+            self._prune(name)
+            return count
+
+    # sorted sets, with the argument order of the legacy redis.Redis client (member, score)
+
+    def zadd(self, name, *args, **kwargs):
+        with self.lock:
+            value = self._get(name, SortedSet, create=True)
+            pairs = zip(args[::2], args[1::2]) + kwargs.items()
+            return len([member for member, score in pairs if value.add(encode(member), float(score))])
+
+    def zcard(self, name):
+        with self.lock:
+            return len(self._get(name, SortedSet) or ())
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        with self.lock:
+            order = (self._get(name, SortedSet) or SortedSet()).order
+            start = max(0, start + len(order) if start < 0 else start)
+            end = min(len(order), end + len(order) + 1 if end < 0 else end + 1)
+            if desc:
+                order = order[len(order) - end:len(order) - start] if end > start else []
+                order.reverse()
+            else:
+                order = order[start:end]
+            return [(member, score) for score, member in order] if withscores else [member for score, member in order]
+
+    def zrangebylex(self, name, min, max, start=None, num=None):
+        with self.lock:
+            order = (self._get(name, SortedSet) or SortedSet()).order
+            order = _range(order, _lex_index(order, min, True), _lex_index(order, max, False), start, num)
+            return [member for score, member in order]
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False):
+        with self.lock:
+            order = (self._get(name, SortedSet) or SortedSet()).order
+            order = _range(order, _score_index(order, min, True), _score_index(order, max, False), start, num)
+            return [(member, score) for score, member in order] if withscores else [member for score, member in order]
+
+    def zrem(self, name, *values):
+        with self.lock:
+            value = self._get(name, SortedSet)
+            if value is None:
+                return 0
+            count = len([item for item in values if value.remove(encode(item))])
+            self._prune(name)
+            return count
+
+    # server
+
+    def config_set(self, name, value):
+        raise redis.ResponseError('MemoryStore does not support CONFIG SET')
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self, transaction)
+
+    def publish(self, channel, message):
+        # there are no subscribers outside of the process
+        return 0
+
+    def pubsub(self, **kwargs):
+        raise redis.RedisError('MemoryStore does not support pub/sub')
+
+    def register_script(self, source):
+        return Script(self, source)
+
+
+class MemoryPipeline(object):
+    """queues commands and applies them together, holding the store's lock, on execute(). they are always applied
+    atomically, transaction is kept for callers that look at it"""
+    def __init__(self, store, transaction=True):
+        self.store = store
+        self.transaction = transaction
+        self.connection_pool = store.connection_pool
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+
+        def queue(*args, **kwargs):
+            self.command_stack.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.store.lock:
+            result = [command(*args, **kwargs) for command, args, kwargs in self.command_stack]
+        self.command_stack = []
+        return result
+
+    def reset(self):
+        self.command_stack = []
@@ -388,12 +388,14 @@ class SuspensionHandler:
 
 
 class Engine:
-    def __init__(self, name, stop_on_errors=True):
+    def __init__(self, name, stop_on_errors=True, after_step=None):
         self.name = name
         self.active = []
         self.inactive = []
         self.running = False
         self.stop_on_errors = stop_on_errors
+        # called once every selector has taken its step
+        self.after_step = after_step
 
     def add_selector(self, selector):
         self.active.append(selector)
@@ -431,6 +433,9 @@ class Engine:
             if selector in self.active:
                 self.active.remove(selector)
 
+        if self.after_step is not None:
+            self.after_step()
+
     def execute(self, cycle=True):
 
         self.running = True
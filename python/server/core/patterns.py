@@ -0,0 +1,26 @@
+"""PatternSet finds which of many literal patterns occur in a string with a single compiled regular expression, rather
+than a substring test per pattern"""
+
+import re
+
+
+class PatternSet(object):
+    def __init__(self, patterns):
+        patterns = set(pattern for pattern in patterns if pattern)
+        # a pattern that occurs brings every pattern it contains with it
+        self.contained = dict((pattern, set(other for other in patterns if other in pattern)) for pattern in patterns)
+
+        # a lookahead tries every position, longest pattern first. only the longest pattern starting at a position is
+        # reported, the shorter ones starting there are contained in it
+        ordered = sorted(patterns, key=len, reverse=True)
+        self.expression = re.compile('(?=(%s))' % '|'.join(re.escape(pattern) for pattern in ordered)) \
+            if len(ordered) > 0 else None
+
+    def search(self, text):
+        """return the set of patterns that occur in text"""
+        result = set()
+        if self.expression is not None:
+            for match in self.expression.finditer(text):
+                result.update(self.contained[match.group(1)])
+
+        return result
@@ -0,0 +1,66 @@
+"""PrefixIndex answers which of a set of root directories contains a path. roots are kept in a trie of path components,
+so a lookup walks the path once, whatever the number of roots"""
+
+import os
+
+# marks the node at which a root ends, path components are never None
+ROOT = None
+
+
+def split(path):
+    return [part for part in path.split(os.path.sep) if part]
+
+
+class PrefixIndex(object):
+    def __init__(self, roots=()):
+        self.roots = set()
+        self.trie = {}
+        for root in roots:
+            self.add(root)
+
+    def __contains__(self, root):
+        return root in self.roots
+
+    def __iter__(self):
+        return iter(list(self.roots))
+
+    def __len__(self):
+        return len(self.roots)
+
+    def add(self, root):
+        node = self.trie
+        for part in split(root):
+            node = node.setdefault(part, {})
+        node[ROOT] = root
+        self.roots.add(root)
+
+    def remove(self, root):
+        if root not in self.roots:
+            return
+
+        self.roots.discard(root)
+        nodes = [self.trie]
+        parts = split(root)
+        for part in parts:
+            nodes.append(nodes[-1][part])
+
+        if nodes[-1].get(ROOT) == root:
+            del nodes[-1][ROOT]
+
+        # prune the branch back to the last node still in use
+        for index in range(len(parts), 0, -1):
+            if len(nodes[index]) > 0:
+                break
+            del nodes[index - 1][parts[index - 1]]
+
+    def longest(self, path):
+        """the longest root that is path or one of its ancestors, or None"""
+        node = self.trie
+        result = node.get(ROOT)
+        for part in split(path):
+            node = node.get(part)
+            if node is None:
+                break
+            result = node.get(ROOT, result)
+
+        return result
@@ -0,0 +1,73 @@
+"""Progress coalesces status updates into at most one published message per interval. Only the latest state is
+kept, intermediate ones are dropped"""
+
+import atexit
+import json
+import logging
+import threading
+import time
+
+import log
+
+LOG = log.get_safe_log(__name__, logging.INFO)
+ERR = log.get_safe_log('errors', logging.WARNING)
+
+
+class Progress(object):
+    def __init__(self, publish, rate=4):
+        """publish is called with the message, a json object of operation, operator, target, count (updates so far)
+        and rate (updates per second since the previous message). rate is the most messages sent per second, with rate
+        0 messages are sent by flush() only"""
+        self.publish = publish
+        self.interval = 1.0 / rate if rate > 0 else None
+        self.lock = threading.Lock()
+        self.state = None
+        self.dirty = False
+        self.count = 0
+        self.published_count = 0
+        self.published = time.time()
+        self.flusher = None
+        atexit.register(self.flush)
+
+    def update(self, operation, operator, target):
+        with self.lock:
+            self.state = (operation, operator, target)
+            self.count += 1
+            self.dirty = True
+            due = self.interval is not None and time.time() - self.published >= self.interval
+
+            if not due and self.flusher is None and self.interval is not None:
+                # publishes whatever is latest once the interval is up, so the end of a burst is not lost
+                self.flusher = threading.Thread(target=self._flush_later, name='progress')
+                self.flusher.daemon = True
+                self.flusher.start()
+
+        if due:
+            self.flush()
+
+    def _flush_later(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.dirty:
+                    self.flusher = None
+                    return
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            now = time.time()
+            operation, operator, target = self.state
+            values = {'operation': operation, 'operator': operator, 'target': target, 'count': self.count,
+                      'rate': round((self.count - self.published_count) / max(now - self.published, 0.001), 1)}
+            self.dirty = False
+            self.published = now
+            self.published_count = self.count
+
+        try:
+            self.publish(json.dumps(values))
+        except Exception, err:
+            ERR.warning('unable to publish progress: %s' % err.message)
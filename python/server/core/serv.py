@@ -57,7 +57,7 @@ class ServiceHost(object):
 
     def initialize(self):
         self.halted = False
-        self.engine = Engine("_engine_", self.stop_on_errors)
+        self.engine = Engine("_engine_", self.stop_on_errors, after_step=self.vector.flush)
         self.selector = Selector("_selector_")
         #TODO: either use before_switch externally using these parameters or remove them and whatever plumbing supports them
         # self.selector = Selector("_selector_", before_switch=self.before_switch, after_switch=self.after_switch)
@@ -145,6 +145,17 @@ def uu_str(value):
     return value
 
 
+def encode(value):
+    """convert value the way redis-py does before sending it, everything is stored as a byte string"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
 def expand_str_to_path(input):
     return os.path.sep.join(list(input))
 
@@ -1,8 +1,9 @@
 
-import sys, os, logging
+import sys, os, logging, atexit, threading, time
 
 import cache2, log
 from introspection import dynamic_func
+from util import encode
 
 LOG = log.get_safe_log(__name__, logging.DEBUG)
 ERR = log.get_safe_log('errors', logging.WARNING)
@@ -41,6 +42,10 @@ class Vector(object):
     def save_to_cache(self):
         pass
 
+    def flush(self):
+        """write out any state held back from the cache"""
+        pass
+
     # FIFO
 
     def clear_fifo(self, consumer):
@@ -121,10 +126,29 @@ class PathVector(Vector):
         self.cycle = cycle
         self.always_peek_fifo = True
 
+        # path -> position in paths, rebuilt when paths is replaced or grows
+        self.path_indexes = {}
+        self.indexed = None
+
     def clear(self):
         super(PathVector, self).clear()
         self.paths = []
 
+    def _indexes(self):
+        if self.indexed != (id(self.paths), len(self.paths)):
+            self.path_indexes = {}
+            for index, path in enumerate(self.paths):
+                self.path_indexes.setdefault(path, index)
+            self.indexed = (id(self.paths), len(self.paths))
+        return self.path_indexes
+
+    def index_of(self, path):
+        """position of path in paths, raises ValueError like list.index() when it is absent"""
+        indexes = self._indexes()
+        if path not in indexes:
+            raise ValueError('%s is not in vector %s' % (path, self.name))
+        return indexes[path]
+
     def clear_active(self, consumer):
         if consumer in self.consumer_paths:
             del self.consumer_paths[consumer]
@@ -145,7 +169,7 @@ class PathVector(Vector):
         result = None
 
         if consumer in self.consumer_paths:
-            index = self.paths.index(self.consumer_paths[consumer]) + 1
+            index = self.index_of(self.consumer_paths[consumer]) + 1
             if len(self.paths) > index:
                 result = self.paths[index]
                 self.consumer_paths[consumer] = result
@@ -170,14 +194,14 @@ class PathVector(Vector):
 
         result = False
         if consumer in self.consumer_paths:
-            index = self.paths.index(self.consumer_paths[consumer]) + 1
+            index = self.index_of(self.consumer_paths[consumer]) + 1
             if len(self.paths) > index or self.cycle: result = True
         else: result = True
 
         return result
 
     def path_in_vector(self, path):
-        return path in self.paths
+        return path in self._indexes()
 
     def path_in_fifo(self, path, consumer):
         if consumer in self.fifos:
@@ -192,7 +216,7 @@ class PathVector(Vector):
             return None
 
         if consumer in self.consumer_paths:
-            index = self.paths.index(self.consumer_paths[consumer]) + 1
+            index = self.index_of(self.consumer_paths[consumer]) + 1
             if len(self.paths) > index:
                 return self.paths[index]
         # elif cycle:
@@ -205,9 +229,42 @@ class PathVector(Vector):
 CACHED_PATH_VECTOR = 'CachedPathVector'
 
 class CachedPathVector(PathVector):
-    def __init__(self, name, paths, cycle=False):
+    """params are written behind: set_param and clear_param change a local copy, which flush() writes with one HMSET
+    (and HDEL) per consumer, in one transaction, at most every flush_interval seconds, on Engine steps and at exit"""
+    def __init__(self, name, paths, cycle=False, flush_interval=5):
         super(CachedPathVector, self).__init__(name, paths, cycle)
         self.consumer_key = cache2.create_key(CACHED_PATH_VECTOR, 'consumers')
+        self._upgrade_positions()
+
+        # consumer -> {param: value}, a value of None is a pending delete
+        self.pending = {}
+        self.pending_lock = threading.RLock()
+        self.flush_interval = flush_interval
+        self.flushed = time.time()
+        atexit.register(self.flush)
+
+    def flush(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+            self.flushed = time.time()
+
+        if len(pending) == 0:
+            return
+
+        with cache2.batch(transaction=True):
+            for consumer, params in pending.items():
+                key = cache2.get_key(CACHED_PATH_VECTOR, consumer)
+                cache2.update_hash2(key, dict((param, value) for param, value in params.items() if value is not None))
+                for param in [param for param, value in params.items() if value is None]:
+                    cache2.delete_hash_value2(key, param)
+
+    def _write_behind(self, consumer, param, value):
+        with self.pending_lock:
+            self.pending.setdefault(consumer, {})[param] = value
+            due = time.time() - self.flushed >= self.flush_interval
+
+        if due:
+            self.flush()
 
     # def clear(self):
     #     super(CachedPathVector, self).clear()
@@ -256,26 +313,21 @@ class CachedPathVector(PathVector):
             cache2.rpush(key, value)
 
     # Params
-    #TODO: rewrite this function using HDEL somewhere in Cache2
+
     def clear_param(self, consumer, param, transient=False):
         if transient:
-            pass
-            #TODO: fill in the blank
+            if consumer in self.params and param in self.params[consumer]:
+                del self.params[consumer][param]
         else:
-            consumer_key = cache2.get_key(CACHED_PATH_VECTOR, consumer)
-            values = cache2.get_hash2(consumer_key)
-            new_values = {}
-            for key in values:
-                if key is not param:
-                    new_values[key] =values[key]
-
-            cache2.set_hash2(consumer_key, new_values)            
+            self._write_behind(consumer, param, None)
 
 
     def clear_params(self, consumer, transient=False):
         if transient:
             super(CachedPathVector, self).clear_params(consumer)
         else:
+            with self.pending_lock:
+                self.pending.pop(consumer, None)
             key = cache2.get_key(CACHED_PATH_VECTOR, consumer)
             cache2.delete_hash2(key)
 
@@ -283,10 +335,12 @@ class CachedPathVector(PathVector):
         if transient:
             return super(CachedPathVector, self).get_param(consumer, param)
         else:
+            with self.pending_lock:
+                if param in self.pending.get(consumer, {}):
+                    return self.pending[consumer][param]
+
             key = cache2.get_key(CACHED_PATH_VECTOR, consumer)
-            values = cache2.get_hash2(key)
-            if param in values:
-                return values[param]
+            return cache2.get_hash_value2(key, param)
 
     def get_params(self, consumer, transient=False):
         if transient:
@@ -294,35 +348,49 @@ class CachedPathVector(PathVector):
         else:
             key = cache2.get_key(CACHED_PATH_VECTOR, consumer)
             values = cache2.get_hash2(key)
+            with self.pending_lock:
+                for param, value in self.pending.get(consumer, {}).items():
+                    if value is None:
+                        values.pop(param, None)
+                    else:
+                        values[param] = value
             return values
 
     def set_param(self, consumer, param, value, transient=False):
         if transient:
             super(CachedPathVector, self).set_param(consumer, param, value)
         else:
-            key = cache2.get_key(CACHED_PATH_VECTOR, consumer)
-            values = cache2.get_hash2(key)
-            values[param] = value
-            cache2.set_hash2(key, values)
+            # kept as redis would return it
+            self._write_behind(consumer, param, encode(value))
 
     # Path
 
-    def clear_active(self, consumer):
-        cached_consumer_paths = cache2.get_hash2(self.consumer_key)
+    # the consumer hash holds each consumer's position: how many paths it has been handed, so that its active path is
+    # paths[position - 1]. get_next advances it with HINCRBY
 
-        if consumer in cached_consumer_paths:
-            del cached_consumer_paths[consumer]
+    def _position(self, consumer):
+        value = cache2.get_hash_value2(self.consumer_key, consumer)
+        return None if value is None else int(value)
 
-        cache2.set_hash2(self.consumer_key, cached_consumer_paths)
+    def _upgrade_positions(self):
+        """consumers used to be stored with their active path, convert those to positions"""
+        for consumer, value in cache2.get_hash2(self.consumer_key).items():
+            if not value.isdigit():
+                try:
+                    cache2.set_hash_value2(self.consumer_key, consumer, self.index_of(value) + 1)
+                except ValueError:
+                    cache2.delete_hash_value2(self.consumer_key, consumer)
 
-    def get_active(self, consumer):
-        cached_consumer_paths = cache2.get_hash2(self.consumer_key)
+    def clear_active(self, consumer):
+        cache2.delete_hash_value2(self.consumer_key, consumer)
 
-        if consumer in cached_consumer_paths:
-            return cached_consumer_paths[consumer]
-        else:
+    def get_active(self, consumer):
+        position = self._position(consumer)
+        if position is None or len(self.paths) == 0:
             return self.get_next(consumer)
 
+        return self.paths[min(position, len(self.paths)) - 1]
+
     def get_next(self, consumer, use_fifo=False):
         if len(self.paths) == 0:
             return None
@@ -330,30 +398,19 @@ class CachedPathVector(PathVector):
         # if (self.always_peek_fifo or use_fifo) and self.peek_fifo(consumer):
         #     return self.pop_fifo(consumer)
 
-        result = None
-
-        cached_consumer_paths = cache2.get_hash2(self.consumer_key)
-
-        if consumer in cached_consumer_paths:
-            index = self.paths.index(cached_consumer_paths[consumer]) + 1
+        position = cache2.increment_hash_value2(self.consumer_key, consumer)
+        if position <= len(self.paths):
+            return self.paths[position - 1]
 
-            if len(self.paths) > index:
-                result = self.paths[index]
-                cached_consumer_paths[consumer] = result
-            elif self.cycle:
-                result = self.paths[0]
-                cached_consumer_paths[consumer] = result
-        else:
-            result = self.paths[0]
-            cached_consumer_paths[consumer] = result
+        if self.cycle:
+            cache2.set_hash_value2(self.consumer_key, consumer, 1)
+            return self.paths[0]
 
-        cache2.set_hash2(self.consumer_key, cached_consumer_paths)
-
-        return result
+        # exhausted, leave the last path active
+        cache2.set_hash_value2(self.consumer_key, consumer, len(self.paths))
 
     def has_active(self, consumer):
-        cached_consumer_paths = cache2.get_hash2(self.consumer_key)
-        return consumer in cached_consumer_paths
+        return self._position(consumer) is not None
 
     def has_next(self, consumer, use_fifo=False):
         if len(self.paths) == 0: 
@@ -362,21 +419,8 @@ class CachedPathVector(PathVector):
         # if (self.always_peek_fifo or use_fifo) and self.peek_fifo(consumer):
         #     return True
 
-        result = False
-
-        cached_consumer_paths = cache2.get_hash2(self.consumer_key)
-        if consumer in cached_consumer_paths:
-            try:
-                index = self.paths.index(cached_consumer_paths[consumer]) + 1
-                if len(self.paths) > index or self.cycle: 
-                    result = True
-            except ValueError, err:
-                result = False
-            
-        else: 
-            result = len(self.paths) > 0
-
-        return result
+        position = self._position(consumer)
+        return position is None or position < len(self.paths) or self.cycle
 
     # def path_in_fifo(self, path, consumer):
     #     cached_consumer_paths = cache2.get_hash2(self.consumer_key)
@@ -393,26 +437,19 @@ class CachedPathVector(PathVector):
         if (self.always_peek_fifo or use_fifo) and self.peek_fifo(consumer) is not None:
             return self.peek_fifo(consumer)
 
-        cached_consumer_paths = cache2.get_hash2(self.consumer_key)
-        if consumer in cached_consumer_paths:
-            index = self.paths.index(cached_consumer_paths[consumer]) + 1
-            if len(self.paths) > index:
-                return self.paths[index]
-        # elif cycle:
-        else: 
+        position = self._position(consumer)
+        if position is None:
             return self.paths[0]
 
+        if position < len(self.paths):
+            return self.paths[position]
+
     def reset(self, consumer, use_fifo=False):
         super(CachedPathVector, self).reset(consumer)
         self.clear_fifo(consumer)
         self.clear_params(consumer)
         self.clear_stack(consumer)
-
-        cached_consumer_paths = cache2.get_hash2(self.consumer_key)
-
-        if consumer in cached_consumer_paths:
-            del cached_consumer_paths[consumer]
-            cache2.set_hash2(self.consumer_key, cached_consumer_paths)
+        self.clear_active(consumer)
 
 PERSIST = 'vector.scan.persist'
 ACTIVE_PATH = 'active.path'
@@ -94,6 +94,24 @@ class ModeStateDefaultParam(Base):
     mode_state_default = relationship(u'ModeStateDefault')
 
 
+class OpLatest(Base):
+    __tablename__ = 'op_latest'
+    __table_args__ = (
+        Index('idx_op_latest_operation_path', 'operation_name', 'target_path', 'operator_name'),
+    )
+
+    path_hash = Column(String(40), primary_key=True, nullable=False)
+    operation_name = Column(String(64), primary_key=True, nullable=False)
+    operator_name = Column(String(64), primary_key=True, nullable=False)
+    pid = Column(String(32), nullable=False)
+    asset_id = Column(String(64), nullable=False)
+    target_path = Column(String(1024), nullable=False)
+    status = Column(String(64), nullable=False)
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime)
+    effective_dt = Column(DateTime, server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"))
+
+
 class OpRecord(Base):
     __tablename__ = 'op_record'
 
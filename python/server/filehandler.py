@@ -25,12 +25,12 @@ def add_attribute(file_format, attribute):
 def get_attributes(file_format, refresh=False):
     """retrieve all attributes, including unused ones, from file_attribute for the specified file_format"""
 
-    items = cache2.get_items(KNOWN, file_format)
+    items = cache2.get_items(KNOWN, file_format, local=True)
     if len(items) == 0 or refresh:
         cache2.clear_items(KNOWN, file_format)
         rows = SQLFileAttribute.retrieve_for_file_format(file_format)
         cache2.add_items(KNOWN, file_format, [row.attribute_name for row in rows])
-        items = cache2.get_items(KNOWN, file_format)
+        items = cache2.get_items(KNOWN, file_format, local=True)
 
     # LOG.debug('get_attributes(file_format=%s) returns: %s' % (file_format, str(items)))
     return items
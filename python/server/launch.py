@@ -42,7 +42,7 @@ def create_service_processes(server, args):
                 path_args = start.get_paths(args)
                 paths = get_directories() if path_args == [] else path_args
 
-            vector = CachedPathVector('path vector', paths)
+            vector = CachedPathVector('path vector', paths, flush_interval=config.param_flush_interval)
             vector.peep_fifo = True
             if args['--expand-all']:
                 vector.set_param('all', 'expand-all', True)
@@ -1,13 +1,20 @@
+import atexit
 import datetime
+import json
 import logging
 import os
 import subprocess
 import sys
+import threading
+import time
+from collections import OrderedDict
 
-from alchemy import SQLOperationRecord, SQLServiceExec
+from alchemy import SQLOperationLatest, SQLOperationRecord, SQLServiceExec
 import config
 import sql
 from core import cache2, log
+from core.journal import Journal
+from core.progress import Progress
 
 from start import show_logo, display_status
 
@@ -17,6 +24,11 @@ ERR = log.get_safe_log('errors', logging.WARNING)
 OPS = 'ops'
 EXEC = 'exec'
 
+DAY = 24 * 60 * 60
+
+# op keys are partitioned by pid and expire once they are older than the op lifespan
+cache2.set_policy(OPS, ttl=config.op_life * DAY, depth=2)
+
 OP_RECORD = {'pid': str(config.pid), 'operation_name': None, 'start_time': config.start_time, 'end_time': None, \
     'asset_id': None, 'target_path': None, 'status': None, 'persisted': False}
 
@@ -47,6 +59,19 @@ def get_op_key(path, operation, operator):
     return cache2.get_key(OPS, config.pid, operation, operator, path)
 
 
+# ops completed in earlier runs, loaded by cache_ops: (root, operation) -> set of (path, operator), see
+# completed_entry(). these never go to Redis, which only holds this run's ops until write_ops_data persists them, so
+# membership costs no round trip
+completed_ops = {}
+
+
+def completed_entry(path, operator):
+    """the completed_ops entry for path and operator. paths come as unicode from some callers and as utf-8 byte
+    strings from others, entries keep them as byte strings so both find the same op"""
+    return (path.encode('utf-8') if isinstance(path, unicode) else path,
+            operator.encode('utf-8') if isinstance(operator, unicode) else operator)
+
+
 @ops_func
 def cache_ops(path, operation, operator=None, apply_lifespan=False, op_status=None):
     if operator is None:
@@ -67,30 +92,35 @@ def cache_ops(path, operation, operator=None, apply_lifespan=False, op_status=No
     LOG.debug('%s caching %i %s operations (%s)...' % (operator, count, operation, op_status))
     for op_record in rows:
         update_listeners('caching %i %s operations  (%s)...' % (count - cached_count, operation, op_status), operator, path)
-        cache_op(op_record)
+        cache_op(op_record, root=path)
         cached_count += 1
 
 @ops_func 
 def discard_ops(path, operation=None, operator=None):
     LOG.debug('discarding op records...')
+    flush_journal()
 
     operator = '*' if operator is None else operator
     operation = '*' if operation is None else operation
 
-    keys = cache2.get_keys(OPS, "*", operation, operator, path)
+    for root, cached_operation in completed_ops.keys():
+        if root == path and operation in ('*', cached_operation):
+            del completed_ops[(root, cached_operation)]
+
+    keys = cache2.iter_keys(OPS, "*", operation, operator, path)
 
     for key in keys:
         record = cache2.get_hash2(key)
         cache2.delete_key(key)
 
 @ops_func 
-def cache_op(op_record):
-    key = cache2.create_key(OPS, config.pid, op_record.operation_name, op_record.operator_name, op_record.target_path)
-    cache2.set_hash2(key, {'persisted': True, 'operation_name':  op_record.operation_name, 'operator_name':  op_record.operator_name, \
-        'target_path': op_record.target_path})
+def cache_op(op_record, root=os.path.sep):
+    completed = completed_ops.setdefault((root, op_record.operation_name), set())
+    completed.add(completed_entry(op_record.target_path, op_record.operator_name))
 
 
 def clear_cached_operation(path, operation, operator=None):
+    flush_journal()
     op_key = get_op_key(path, operation, operator)
     cache2.delete_hash2(op_key)
     cache2.delete_key(op_key)
@@ -100,14 +130,12 @@ def flush_cache(resuming=False):
     write_ops_data(os.path.sep, resuming=resuming)
     if resuming is False:
         LOG.info('flushing redis datastore, keys remain')
-        cache2.datastore.flushdb()
-        cache2.hashstore.flushdb()
-        cache2.liststore.flushdb()
-        cache2.orderedliststore.flushdb()
+        cache2.flush_values()
 
 
 def mark_operation_invalid(path, operation, operator):
     LOG.debug("marking operation invalid: %s:::%s - path %s " % (operator, operation, path))
+    flush_journal()
 
     op_key = get_op_key(path, operation, operator)
     values = cache2.get_hash2(op_key)
@@ -117,12 +145,7 @@ def mark_operation_invalid(path, operation, operator):
 
 def operation_completed(path, operation, operator=None):
     LOG.debug("checking for record of %s:::%s on path %s " % (operator, operation, path))
-    if operator is None:
-        rows = sql.retrieve_values('op_record', ['operation_name', 'target_path', 'status', 'start_time', 'end_time'],
-                                   [operation, path, 'COMPLETE'])
-    else:
-        rows = sql.retrieve_values('op_record', ['operator_name', 'operation_name', 'target_path', 'status', 'start_time', 'end_time'],
-                                   [operator, operation, path, 'COMPLETE'])
+    rows = SQLOperationLatest.retrieve_for_path(path, operation, operator)
 
     result = len(rows) > 0
     LOG.debug('operation_completed(path=%s, operation=%s) returns %s' % (path, operation, str(result)))
@@ -130,78 +153,124 @@ def operation_completed(path, operation, operator=None):
 
 
 def operation_in_cache(path, operation, operator=None):
-    op_key = get_op_key(path, operation, operator)
-    values = cache2.get_hash2(op_key)
-    return 'persisted' in values and values['persisted'] == 'True'
+    entry = completed_entry(path, operator)
+    for (root, cached_operation), completed in completed_ops.iteritems():
+        if cached_operation == operation and entry in completed:
+            return True
+    return False
     #LOG.debug('operation_in_cache(path=%s, operation=%s) returns %s' % (path, operation, str(result)))
 
 
-def pop_operation():
-    stack_key = cache2.get_key(OPS, config.pid, 'op-stack')
-    cache2.lpop2(stack_key)
-    
-    last_op_key = cache2.lpeek2(stack_key)
+# op journal
+
+# begin and complete events are appended to the journal and applied to Redis in batches by a flusher thread, every
+# config.journal_flush_interval seconds and before anything reads op records back. without a journal (see
+# open_journal) they are applied as they happen
+journal = None
+journal_lock = threading.RLock()
+
+# this process's operations in progress, innermost last, as (path, operation, operator)
+active_ops = []
+
+def open_journal(path, interval=1):
+    """journal ops to this process's journal at path, replaying whatever exited processes left there"""
+    global journal
+    journal = Journal(path, pid=config.pid)
+    atexit.register(flush_journal)
+
+    flusher = threading.Thread(target=_flush_journal_every, args=(interval,), name='ops-journal')
+    flusher.daemon = True
+    flusher.start()
+
+
+def _flush_journal_every(interval):
+    while True:
+        time.sleep(interval)
+        flush_journal()
+
 
-    if last_op_key is None or last_op_key == 'None':
-        set_service_execord_value('current_operation', None)
-        set_service_execord_value('current_operator', None)
-        set_service_execord_value('operation_status', None)
-        update_listeners('', '', '')
+def flush_journal():
+    if journal is None:
+        return
+
+    with journal_lock:
+        entries = journal.take()
+        if len(entries) == 0:
+            return
+        try:
+            _apply_op_entries(entries)
+            journal.done()
+        except Exception, err:
+            journal.restore(entries)
+            ERR.warning('unable to apply %i journaled ops: %s' % (len(entries), err.message))
+
+
+def _journal_op(event, path, operation, operator, **values):
+    entry = dict(values, event=event, pid=str(config.pid), path=path, operation=operation, operator=operator,
+                 time=datetime.datetime.now().isoformat())
+    if journal is None:
+        with journal_lock:
+            _apply_op_entries([entry])
     else:
-        op_rec = cache2.get_hash2(last_op_key)
-        service_exec = cache2.get_hash2(get_exec_key())
-        
-        service_exec['current_operation'] = op_rec['operation_name']
-        service_exec['current_operator'] = op_rec['operator_name']
-        service_exec['operation_status'] = op_rec['status']
-        cache2.set_hash2(get_exec_key(), service_exec)
+        journal.append(entry)
+
+
+def _apply_op_entries(entries):
+    # the final fields of each op, in order of first appearance
+    records = OrderedDict()
+    for entry in entries:
+        names = (entry['pid'], entry['operation'], entry['operator'], entry['path'])
+        if entry['event'] == 'begin':
+            records[names] = dict(OP_RECORD, pid=entry['pid'], operation_name=entry['operation'], 
+                                  operator_name=entry['operator'], target_path=entry['path'], 
+                                  start_time=entry['time'], asset_id=entry.get('esid'), status='ACTIVE', created=True)
+        else:
+            fields = records.setdefault(names, {})
+            fields['status'] = 'FAIL' if entry.get('failed') else 'COMPLETE'
+            fields['end_time'] = entry['time']
+
+    with cache2.batch(transaction=True):
+        for names, fields in records.items():
+            if fields.pop('created', False):
+                key = cache2.create_key(OPS, *names)
+            else:
+                key = cache2.key_name(OPS, *names)
+            cache2.update_hash2(key, fields)
 
-        update_listeners(op_rec['operation_name'], op_rec['operator_name'], op_rec['target_path'])
+        with journal_lock:
+            current = active_ops[-1] if len(active_ops) > 0 else (None, None, None)
+        cache2.update_hash2(get_exec_key(), {'current_operation': current[1], 'current_operator': current[2], 
+                                             'operation_status': None if current[1] is None else 'ACTIVE'})
+
+
+def pop_operation(path, operation, operator):
+    with journal_lock:
+        if (path, operation, operator) in active_ops:
+            active_ops.remove((path, operation, operator))
+        current = active_ops[-1] if len(active_ops) > 0 else ('', '', '')
+
+    update_listeners(current[1], current[2], current[0])
 
 
 def push_operation(path, operation, operator):
-    op_key = get_op_key(path, operation, operator)
-    stack_key = cache2.get_key(OPS, config.pid, 'op-stack')
-    cache2.lpush(stack_key, op_key)
+    with journal_lock:
+        active_ops.append((path, operation, operator))
 
     update_listeners(operation, operator, path)
 
 
 def record_op_begin(path, operation, operator, esid=None):
     LOG.debug("recording operation beginning: %s:::%s on %s" % (operator, operation, path))
-    
-    op_record = OP_RECORD
-    op_record['operation_name'] = operation
-    op_record['operator_name'] = operator
-    op_record['start_time'] = datetime.datetime.now().isoformat()
-    if esid:
-        op_record['asset_id'] = esid
-    op_record['target_path'] = path
-    op_record['status'] = 'ACTIVE'
-    op_key = create_op_key(path, operation, operator)
-    cache2.set_hash2(op_key, op_record)
-
-    service_exec = cache2.get_hash2(get_exec_key())
-    service_exec['current_operation'] = operation
-    service_exec['current_operator'] = operator
-    service_exec['operation_status'] = 'ACTIVE'
-    cache2.set_hash2(get_exec_key(), service_exec)
 
     push_operation(path, operation, operator)
-    update_listeners(operation, operator, path)
+    _journal_op('begin', path, operation, operator, esid=esid)
 
 def record_op_complete(path, operation, operator, esid=None, op_failed=False):
     LOG.debug("recording operation complete: %s:::%s on %s - path %s " % (operator, operation, esid, path))
 
-    op_key = get_op_key(path, operation, operator)
-    record = cache2.get_hash2(op_key)
-
-    if len(record) > 0:
-        record['status'] = "FAIL" if op_failed else 'COMPLETE'
-        record['end_time'] = datetime.datetime.now().isoformat()
-        cache2.set_hash2(op_key, record)
-
-        pop_operation()
+    if (path, operation, operator) in active_ops:
+        pop_operation(path, operation, operator)
+        _journal_op('complete', path, operation, operator, failed=op_failed)
 
 
 def retrieve_ops__data(path, operation, operator=None, apply_lifespan=False):
@@ -224,11 +293,12 @@ def retrieve_ops__data(path, operation, operator=None, apply_lifespan=False):
 
 def update_ops_data(path, key, value, operation=None, operator=None):
     LOG.debug('updating operation records')
+    flush_journal()
 
     operator = '*' if operator is None else operator
     operation = '*' if operation is None else operation
 
-    op_keys = cache2.get_keys(OPS, config.pid, operation, operator, path)
+    op_keys = cache2.iter_keys(OPS, config.pid, operation, operator, path)
     for op_key in op_keys:
         record = cache2.get_hash2(op_key)
         if len(record) > 0:
@@ -236,8 +306,39 @@ def update_ops_data(path, key, value, operation=None, operator=None):
             cache2.set_hash2(op_key, record)
 
 
+def _unpersisted_ops(keys, written, resuming=False):
+    """yield the op records under keys that still need writing as SQLOperationRecord.insert() arguments, reading
+    their hashes one batch at a time. the key of every record yielded is appended to written"""
+    for start in range(0, len(keys), config.sql_batch_size):
+        batch = keys[start:start + config.sql_batch_size]
+        for key, record in zip(batch, cache2.get_hashes2(batch)):
+            skip = False
+            for field in OP_RECORD:
+                if not field in record:
+                    skip = True
+                    break
+
+            if skip or record['persisted'] == 'True' or record['status'] == 'INVALID': 
+                continue
+
+            if record['end_time'] == 'None':
+                record['status'] = 'INCOMPLETE' if resuming is False else 'INTERRUPTED'
+
+            if record['status'] == 'INCOMPLETE':
+                record['end_time'] = datetime.datetime.now().isoformat()
+
+            # TODO: if esids were cached after asset has been indexed, they COULD be inserted HERE instead of using update_ops_data() post-ipso
+            update_listeners('writing %s' % record['operation_name'], record['operator_name'], record['target_path'])
+
+            written.append(key)
+            yield {'operation_name': record['operation_name'], 'operator_name': record['operator_name'], 
+                   'asset_id': record['asset_id'], 'target_path': record['target_path'], 
+                   'start_time': record['start_time'], 'end_time': record['end_time'], 'status': record['status']}
+
+
 def write_ops_data(path, operation=None, operator=None, resuming=False):
     LOG.debug('writing op records...')
+    flush_journal()
 
     operator = '*' if operator is None else operator
     operation = '*' if operation is None else operation
@@ -247,35 +348,15 @@ def write_ops_data(path, operation=None, operator=None, resuming=False):
     # else:
     #     keys = cache2.get_keys(OPS, config.pid, operation, operator, path)
 
-    keys = cache2.get_keys(OPS, "*", operation, operator, path)
-
-    for key in keys:
-        record = cache2.get_hash2(key)
-        skip = False
-        for field in OP_RECORD:
-            if not field in record:
-                skip = True
-                break
+    keys = list(cache2.iter_keys(OPS, "*", operation, operator, path))
+    written = []
 
-        if skip or record['persisted'] == 'True' or record['status'] == 'INVALID': 
-            continue
+    # rows are inserted as they are read, the keys are only deleted once they have all been committed
+    SQLOperationRecord.insert_all(_unpersisted_ops(keys, written, resuming), batch_size=config.sql_batch_size)
 
-        if record['end_time'] == 'None':
-            record['status'] = 'INCOMPLETE' if resuming is False else 'INTERRUPTED'
-
-        if record['status'] == 'INTERRUPTED':
-            pass
-
-        if record['status'] == 'INCOMPLETE':
-            record['end_time'] = datetime.datetime.now().isoformat()
-
-        # TODO: if esids were cached after asset has been indexed, they COULD be inserted HERE instead of using update_ops_data() post-ipso
-        update_listeners('writing %s' % record['operation_name'], record['operator_name'], record['target_path'])
-
-        SQLOperationRecord.insert(operation_name=record['operation_name'], operator_name=record['operator_name'], asset_id=record['asset_id'], \
-            target_path=record['target_path'], start_time=record['start_time'], end_time=record['end_time'], status=record['status'])
-
-        cache2.delete_key(key)
+    with cache2.batch():
+        for key in written:
+            cache2.delete_key(key)
 
     LOG.info('%s operations have been updated for %s in MySQL' % (operation, path))
 
@@ -344,10 +425,60 @@ def append_command(command, **kwargs):
     set_service_execord_value(command, **kwargs)
 
 
-def check_status(opcount=None):
+# control flags
+
+# check_status reads these flags instead of the exec record. a listener thread refreshes them whenever control.py
+# announces a change on the process's control channel, and every config.control_refresh seconds regardless
+control_flags = None
 
+def control_channel(pid):
+    return cache2.DELIM.join(['control', str(pid)])
+
+
+def read_control_flags():
     values = cache2.get_hash2(get_exec_key())
-    if 'pid' not in values:
+    own = values.get('pid') == config.pid
+    return {'pid': 'pid' in values, 'stop': own and values.get('stop_requested') == 'True',
+            'halt': own and values.get('halt_requested') == 'True',
+            'reconfig': own and values.get('reconfig_requested') == 'True'}
+
+
+def _listen_for_control(pubsub):
+    global control_flags
+    while True:
+        try:
+            if pubsub is None:
+                time.sleep(config.control_refresh)
+            else:
+                pubsub.get_message(timeout=config.control_refresh)
+            control_flags = read_control_flags()
+        except Exception, err:
+            ERR.warning('unable to refresh control flags: %s' % err.message)
+            time.sleep(config.control_refresh)
+
+
+def listen_for_control():
+    global control_flags
+    control_flags = read_control_flags()
+
+    pubsub = None
+    try:
+        pubsub = cache2.datastore.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(control_channel(config.pid))
+    except Exception, err:
+        ERR.warning('control channel unavailable, control flags refresh every %s seconds: %s' % (config.control_refresh, err.message))
+        pubsub = None
+
+    listener = threading.Thread(target=_listen_for_control, args=(pubsub,), name='ops-control')
+    listener.daemon = True
+    listener.start()
+
+
+def check_status(opcount=None):
+    if control_flags is None:
+        listen_for_control()
+
+    if not control_flags['pid']:
         ERR.error('NO PID!!!')
         sys.exit(1)
         
@@ -361,7 +492,7 @@ def check_status(opcount=None):
     #     start.execute()
     #     clear_reconfig_request()
 
-    if stop_requested():
+    if control_flags['stop']:
         print('STOP requested. Stopping...')
         LOG.debug('STOP requested, terminating...')
         update_listeners(OPS, get_exec_key(), 'terminating')
@@ -373,7 +504,7 @@ def check_status(opcount=None):
         LOG.debug('system stopped')
         sys.exit(0)
 
-    if halt_requested():
+    if control_flags['halt']:
         print( 'HALT requested. Halting...')
         LOG.debug('HALT requested, terminating...')
         update_listeners(OPS, get_exec_key(), 'terminating')
@@ -448,15 +579,21 @@ def start_requested():
 
 # redis pub/sub
 
+def publish_progress(message):
+    """publish a Progress message on the OPS channel, and its fields on the operation, operator and target channels
+    MildredCacheMonitor subscribes to"""
+    cache2.datastore.publish('OPS', message)
+    values = json.loads(message)
+    for channel in ('operation', 'operator', 'target'):
+        cache2.datastore.publish(channel, values[channel])
+
+# listeners get the latest state, config.progress_rate times a second at most
+PROGRESS = Progress(publish_progress, rate=config.progress_rate)
+
 def update_listeners(operation, operator, target):
     
     operation = '' if operation is None else operation
     operator = '' if operator is None else operator
     target = '' if target is None else target
 
-    # name = 'OPS'
-    # channel = 'OPS'
-    # message = '%s*%s*%s' % (operation, operator, target)
-    cache2.datastore.publish('operation', operation)
-    cache2.datastore.publish('operator', operator)
-    cache2.datastore.publish('target', target)
+    PROGRESS.update(operation, operator, target)
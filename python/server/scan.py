@@ -73,11 +73,12 @@ class FileScanner(Walker):
 
 
     @ops_func
-    def process_file(self, path):
+    def process_file(self, path, asset=None):
 
         directory = assets.get_cached_directory()
         try:           
-            asset = assets.retrieve_asset(path, check_db=True)
+            if asset is None:
+                asset = assets.retrieve_asset(path, check_db=True)
             if asset.available is False: 
                 return
 
@@ -95,9 +96,10 @@ class FileScanner(Walker):
 
             if asset.esid is None:
                 data['directory'] = directory['esid']
-                asset.esid = assets.create_asset_metadata(data, self.get_or_create_file_type(path))
+                asset.esid = assets.queue_asset_metadata(data, self.get_or_create_file_type(path),
+                                                         on_error=self.handle_index_error if file_was_read else None)
             else:
-                assets.update_asset(data)
+                assets.update_asset(data, on_error=self.handle_index_error if file_was_read else None)
             # ordering dependencies end
 
             if file_was_read:
@@ -114,6 +116,9 @@ class FileScanner(Walker):
             if file_was_read:
                 self.reader.invalidate_read_ops(path)
 
+    def handle_index_error(self, data):
+        self.reader.invalidate_read_ops(data['absolute_path'])
+
 
     # Walker methods
 
@@ -133,9 +138,9 @@ class FileScanner(Walker):
             assets.set_active_directory(None)
             return
 
-        if os.path.isdir(root) and os.access(root, os.R_OK):
-            if file_type_recognized(root, self.reader.extensions):
-                directory = Directory(root)
+        directory = Directory(root, contents=self.current_dirs + self.current_files)
+        if directory.available:
+            if file_type_recognized(root, self.reader.extensions, names=self.current_files):
                 data = assets.directory_attribs(directory)
                 if data['attributes']['album']:
                     LOG.info("adding %s to media paths." % (root))
@@ -150,7 +155,7 @@ class FileScanner(Walker):
                     shallow.set_directory_type(root, 'recent')
 
             try:
-                assets.set_active_directory(root)
+                assets.set_active_directory(root, contents=self.current_dirs + self.current_files)
             except ElasticDataIntegrityException, err:
                 ERR.warning(': '.join([err.__class__.__name__, err.message]))
                 assets.handle_asset_exception(err, root)
@@ -164,7 +169,7 @@ class FileScanner(Walker):
                 #     # ops.invalid
                 #     raise err
         
-        elif os.access(root, os.R_OK) == False:
+        else:
             # self.vector.push_fifo(SCAN, root)
             # raise Exception("%s isn't currently available." % (root))
             if root is not None:
@@ -182,11 +187,14 @@ class FileScanner(Walker):
         ops.update_listeners('scanning', SCANNER, root)
         ops.record_op_begin(directory['absolute_path'], SCAN, SCANNER, directory['esid'])
             
-        for filename in os.listdir(root):
-            path = os.path.join(root, filename)
-            if os.path.isfile(path):
-                self.process_file(path)
-
+        # os.walk() has already told files from directories, resolve_assets() stats each file once
+        paths = [os.path.join(root, filename) for filename in self.current_files]
+        resolved = assets.resolve_assets(paths)
+        for path in paths:
+            self.process_file(path, resolved[path])
+
+        # the directory only counts as scanned once its documents are written
+        assets.flush_asset_metadata()
         ops.record_op_complete(directory['absolute_path'], SCAN, SCANNER, directory['esid'])
         LOG.debug('done scanning : %s' % (root))
 
@@ -201,10 +209,10 @@ class FileScanner(Walker):
         expanded = False
         do_expand = False
 
-        if path in shallow.get_directories():
+        if path in shallow.get_directory_index():
             do_expand = True
         
-        if path in self.vector.paths:
+        if self.vector.path_in_vector(path):
             if self.vector.get_param('all', 'expand-all'):
                 do_expand = True
         
@@ -344,9 +352,9 @@ class FileScanner(Walker):
 # TODO: use _handle_dir and handle_file instead of whatever the hell it is that you're doing above
 
 # TODO: Offline mode - query MySQL and ES before looking at the file system
-def file_type_recognized(path, extensions, recursive=False):
-    if os.path.isdir(path):
-        for f in os.listdir(path):
+def file_type_recognized(path, extensions, recursive=False, names=None):
+    if names is not None or os.path.isdir(path):
+        for f in os.listdir(path) if names is None else names:
             for ext in extensions:
                 if f.lower().endswith('.' + ext.lower()):
                     return True
@@ -1,5 +1,6 @@
 from core import cache2
 import os
+import time
 import config, alchemy
 
 from const import DIRECTORY, FILE
@@ -8,11 +9,12 @@ from core import cache2
 from assets import PATTERN, set_active_directory
 
 from alchemy import SQLDirectoryType
+from core.prefixes import PrefixIndex
 
 def get_sorted_items(keygroup, identifier):
-    key = cache2.get_key(keygroup, identifier)
+    key = cache2.key_name(keygroup, identifier)
     result = []
-    result.extend(cache2.get_items2(key))
+    result.extend(cache2.get_items2(key, local=True))
     result.sort()
     return result
 
@@ -21,7 +23,7 @@ def get_file_types(refresh=False):
     keygroup = FILE
     identifier = 'file_types'
 
-    items = cache2.get_items(keygroup, identifier)
+    items = cache2.get_items(keygroup, identifier, local=True)
     if len(items) == 0 or refresh:
         cache2.clear_items(keygroup, identifier)
         key = cache2.get_key(keygroup, identifier)
@@ -35,7 +37,7 @@ def get_categories(refresh=False):
     keygroup = FILE
     identifier = 'categories'
 
-    items = cache2.get_items(keygroup, identifier)
+    items = cache2.get_items(keygroup, identifier, local=True)
     if len(items) == 0 or refresh:
         cache2.clear_items(keygroup, identifier)
         key = cache2.get_key(keygroup, identifier)
@@ -62,12 +64,13 @@ def get_directories(refresh=False, directory_type=None):
     keygroup = DIRECTORY
     identifier = 'directories'
     # if directory_type is None:
-    items = cache2.get_items(keygroup, identifier)
+    items = cache2.get_items(keygroup, identifier, local=True)
     if len(items) == 0 or refresh:
         cache2.clear_items(keygroup, identifier)
         key = cache2.get_key(keygroup, identifier)
         rows = alchemy.SQLDirectory.retrieve_all()
         cache2.add_items2(key, [directory.name for directory in rows])
+        clear_directory_index()
 
     return get_sorted_items(keygroup, identifier)
 
@@ -75,11 +78,30 @@ def get_directories(refresh=False, directory_type=None):
     #     return alchemy.SQLDirectory.retrieve_all(directory_type)
 
 
+# get_directories() as a PrefixIndex. it is rebuilt when this process reloads the directories and, since other
+# processes add directories too, once it is as old as the local tier lets the directory list itself get
+directory_index = None
+directory_index_built = None
+
+def clear_directory_index():
+    global directory_index
+    directory_index = None
+
+
+def get_directory_index(refresh=False):
+    global directory_index, directory_index_built
+    if refresh or directory_index is None or time.time() - directory_index_built > config.local_tier_ttl:
+        directory_index = PrefixIndex(get_directories(refresh))
+        directory_index_built = time.time()
+
+    return directory_index
+
+
 def get_directory_types(refresh=False):
     keygroup = DIRECTORY
     identifier = 'directory_type'
 
-    items = cache2.get_items(keygroup, identifier)
+    items = cache2.get_items(keygroup, identifier, local=True)
     if len(items) == 0 or refresh:
         cache2.clear_items(keygroup, identifier)
         key = cache2.get_key(keygroup, identifier)
@@ -91,7 +113,7 @@ def get_directory_types(refresh=False):
 
 def get_directory_constants(directory_type, refresh=False):
 
-    items = cache2.get_items(PATTERN, directory_type)
+    items = cache2.get_items(PATTERN, directory_type, local=True)
     if len(items) == 0 or refresh:
         cache2.clear_items(PATTERN, directory_type)
         key = cache2.create_key(PATTERN, directory_type)
@@ -105,7 +127,7 @@ def get_directory_patterns(refresh=False):
     keygroup = DIRECTORY
     identifier = 'patterns'
     # if directory_type is None:
-    items = cache2.get_items(keygroup, identifier)
+    items = cache2.get_items(keygroup, identifier, local=True)
     if len(items) == 0 or refresh:
         cache2.clear_items(keygroup, identifier)
         key = cache2.get_key(keygroup, identifier)
@@ -11,9 +11,11 @@ import const
 import core.var
 from core import cache2
 from core import log
+from core import memstore
 import ops
 import search
 import sql
+from alchemy import SQLOperationLatest
 
 LOG = log.get_safe_log(__name__, logging.DEBUG)
 ERR = log.get_safe_log('errors', logging.WARNING)
@@ -34,7 +36,15 @@ def execute(args):
         try:
             # TODO: connect to an explicit redis database. Check for execution record. Change database if required.
             LOG.debug('connecting to Redis...')
-            initialize_cache2(config.redis_host)
+            initialize_cache2(config.redis_host, scan_count=config.scan_count, shared=config.redis_shared,
+                              backend=config.redis_backend)
+            cache2.build_indexes()
+            # replays ops a crashed run left unapplied
+            ops.open_journal(config.journal_path, interval=config.journal_flush_interval)
+            if config.local_tier:
+                # every write to the memory backend happens in this process, so nothing else to listen for
+                cache2.enable_local_tier(size=config.local_tier_size, ttl=config.local_tier_ttl,
+                                         notify=config.redis_backend == 'redis')
 
         except Exception, err:
             config.started = False
@@ -43,6 +53,12 @@ def execute(args):
             raise err
 
         try:
+            # documents wait here while Elasticsearch is unavailable. assets imports start through ops, so it can't be
+            # imported with the rest
+            import assets
+            if config.es_outbox:
+                assets.open_outbox(config.es_outbox, retry=config.es_outbox_retry)
+
             LOG.debug('connecting to Elasticsearch...')
             config.es = search.connect(config.es_host, config.es_port)
             if not config.es.indices.exists(config.es_dir_index):
@@ -59,6 +75,8 @@ def execute(args):
         try:
             LOG.debug('connecting to MySQL...')
             # load_user_info()
+            # databases that predate op_latest have their completed ops in op_record only
+            SQLOperationLatest.backfill()
         except Exception, err:
             config.started = False
             ERR.error(err.message)
@@ -148,7 +166,7 @@ def reset(args):
         query = 'delete from %s' % (table)
         sql.execute_query(query, schema=config.db_media)
 
-    for table in ['op_record', 'mode_state', 'service_exec']:
+    for table in ['op_latest', 'op_record', 'mode_state', 'service_exec']:
         query = 'delete from %s' % (table)
         sql.execute_query(query, schema=config.db_service)
 
@@ -195,9 +213,26 @@ def display_redis_status():
     print('')
     
 
-def initialize_cache2(host, key_db=0, data_db=1, hash_db=2, list_db=3, ord_list_db=4):
-    cache2.keystore = redis.Redis(host, db=key_db)
-    cache2.datastore = redis.Redis(host, db=data_db)
-    cache2.hashstore = redis.Redis(host, db=hash_db)
-    cache2.liststore = redis.Redis(host, db=list_db)
-    cache2.orderedliststore = redis.Redis(host, db=ord_list_db)
+def initialize_cache2(host, key_db=0, data_db=1, hash_db=2, list_db=3, ord_list_db=4, scan_count=None, shared=False,
+                      backend='redis'):
+    if scan_count is not None:
+        cache2.scan_count = scan_count
+
+    # the memory backend keeps everything in this process, host is ignored
+    connect = memstore.MemoryStore if backend == 'memory' else lambda db: redis.Redis(host, db=db)
+
+    if shared:
+        # one connection pool on key_db, each store is a key prefix
+        client = connect(key_db)
+        cache2.keystore = cache2.Namespace(client, 'k:')
+        cache2.datastore = cache2.Namespace(client, 'd:')
+        cache2.hashstore = cache2.Namespace(client, 'h:')
+        cache2.liststore = cache2.Namespace(client, 'l:')
+        cache2.orderedliststore = cache2.Namespace(client, 'o:')
+        return
+
+    cache2.keystore = connect(key_db)
+    cache2.datastore = connect(data_db)
+    cache2.hashstore = connect(hash_db)
+    cache2.liststore = connect(list_db)
+    cache2.orderedliststore = connect(ord_list_db)
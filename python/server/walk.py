@@ -8,6 +8,9 @@ class Walker(object):
         self.current_root = None
         self.current_filename = None
         self.current_dir = None
+        # the names os.walk() found in the current root, so handlers need not list it again
+        self.current_dirs = []
+        self.current_files = []
 
     def after_handle_dir(self, directory):
         pass
@@ -47,6 +50,8 @@ class Walker(object):
 
     def walk(self, start):
         for root, dirs, files in os.walk(start, topdown=True, followlinks=False):
+            self.current_dirs = dirs
+            self.current_files = files
             try:
                 self.before_handle_root(root)
                 self.current_root = root
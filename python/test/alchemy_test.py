@@ -1,3 +1,4 @@
+import datetime
 import unittest
 
 from ..server import alchemy, sql
@@ -56,6 +57,23 @@ class TestAlchemy(unittest.TestCase):
             pass
         else: raise Exception('invalid data for tests')
 
+    def test_op_latest_out_of_order(self):
+        path = '/tests/alchemy/op_latest'
+        row = {'operation_name': 'scan', 'operator_name': 'tests', 'asset_id': 'tests', 'target_path': path,
+               'status': 'COMPLETE', 'end_time': None}
+        newer = dict(row, pid='newer', start_time=datetime.datetime(2018, 5, 2))
+        older = dict(row, pid='older', start_time=datetime.datetime(2018, 5, 1))
+        try:
+            # records from different pids are flushed in key order, the older one can come second
+            alchemy.SQLOperationLatest.upsert_all([newer])
+            alchemy.SQLOperationLatest.upsert_all([older])
+            alchemy.sessions[alchemy.SERVICE].commit()
+
+            latest = alchemy.SQLOperationLatest.retrieve_for_path(path, 'scan', 'tests')
+            self.assertEquals([(op.pid, op.start_time) for op in latest], [('newer', newer['start_time'])])
+        finally:
+            sql.execute_query("delete from op_latest where target_path = '%s'" % path, schema='service')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,6 +1,8 @@
 import redis
 import unittest
 
+# ops before start, each imports the other
+from ..server import ops
 from ..server import start
 from ..server.core import cache2
 
@@ -11,8 +13,12 @@ KEYGROUP = 'tests-suite'
 
 class TestCache2(unittest.TestCase):
     """Redis must be running for these tests to run"""
+    shared = False
+    backend = 'redis'
+
     def setUp(self):
-        start.initialize_cache2('localhost', key_db=10, data_db=11, hash_db=12, list_db=13, ord_list_db=14)
+        start.initialize_cache2('localhost', key_db=10, data_db=11, hash_db=12, list_db=13, ord_list_db=14, shared=self.shared,
+                                backend=self.backend)
         cache2.flush_all()
 
         self.identifiers = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i']
@@ -29,7 +35,7 @@ class TestCache2(unittest.TestCase):
         key = cache2.create_key(KEYGROUP, 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', value='tests')
         self.assertEquals(key, self.identifier, 'error in key name')
 
-        testkey = cache2.datastore.keys(self.identifier)
+        testkey = cache2.keystore.keys(self.identifier)
         self.assertTrue(testkey  == [self.identifier], 'no key returned for "%s"' % self.identifier)
 
     def test_create_key_no_values(self):
@@ -48,6 +54,55 @@ class TestCache2(unittest.TestCase):
         testkey = cache2.keystore.keys(key)
         self.assertEquals(testkey, [], 'delete_key fails')
 
+    def test_batch(self):
+        with cache2.batch():
+            key = cache2.create_key(KEYGROUP, 'batch', value='tests')
+            cache2.set_hash2(key, {'operation': 'scan', 'operator': 'id3v2'})
+            cache2.add_items2(key, self.test_vals)
+
+            # queued writes are not visible until the batch is flushed
+            self.assertEquals(cache2.keystore.keys(key), [])
+
+        self.assertEquals(cache2.keystore.keys(key), [key])
+        self.assertDictEqual(cache2.get_hash2(key), {'operation': 'scan', 'operator': 'id3v2'})
+        self.assertItemsEqual(cache2.get_items2(key), self.test_vals)
+
+        with cache2.batch():
+            cache2.delete_key(key)
+
+        self.assertEquals(cache2.keystore.keys(key), [])
+        self.assertDictEqual(cache2.get_hash2(key), {})
+        self.assertItemsEqual(cache2.get_items2(key), [])
+
+    def test_batch_nested_error(self):
+        with cache2.batch():
+            key = cache2.create_key(KEYGROUP, 'nested_error')
+            try:
+                with cache2.batch(transaction=True):
+                    cache2.set_hash2(key, {'operation': 'scan'})
+                    raise RuntimeError('nested')
+            except RuntimeError:
+                pass
+            cache2.add_items2(key, self.test_vals)
+
+        # the outer batch's commands are sent, the failed nested batch's are not
+        self.assertEquals(cache2.get_keys(KEYGROUP, 'nested_error'), [key])
+        self.assertDictEqual(cache2.get_hash2(key), {})
+        self.assertItemsEqual(cache2.get_items2(key), self.test_vals)
+
+    def test_batch_size(self):
+        with cache2.batch(size=2) as batch:
+            for val in self.test_vals:
+                cache2.add_item(KEYGROUP, 'batch_size', val)
+            self.assertTrue(batch.queued <= 2)
+
+        with cache2.batch(transaction=True, size=2) as batch:
+            for val in self.test_vals:
+                cache2.add_item(KEYGROUP, 'batch_size_transaction', val)
+            # a transaction is sent whole
+            self.assertEquals(batch.queued, len(self.test_vals))
+        self.assertItemsEqual(cache2.get_items(KEYGROUP, 'batch_size_transaction'), self.test_vals)
+
     def test_delete_key_group(self):
         pass
 
@@ -55,14 +110,36 @@ class TestCache2(unittest.TestCase):
         pass
 
     def test_get_key(self):
-        # get_key() calls get_keys, unit tests is redundant
-        pass
+        key = cache2.get_key(KEYGROUP, 'get_key')
+        self.assertEquals(key, cache2.DELIM.join([KEYGROUP, 'get_key']))
+        self.assertEquals(cache2.get_key(KEYGROUP, 'get_key'), key)
+        self.assertEquals(cache2.keystore.llen(key), 1, 'get_key recreates existing key')
+
+    def test_get_keys_wildcard(self):
+        keys = [cache2.create_key(KEYGROUP, val, 'wildcard') for val in self.test_vals]
+        cache2.create_key(KEYGROUP, 'a', 'other')
+
+        self.assertItemsEqual(keys, cache2.get_keys(KEYGROUP, cache2.WILDCARD, 'wildcard'))
+
+    def test_build_indexes(self):
+        key = cache2.DELIM.join([KEYGROUP, 'build_indexes'])
+        cache2.keystore.rpush(key, None)
+        self.assertEquals(cache2.get_keys(KEYGROUP, 'build_indexes'), [])
+
+        cache2.build_indexes()
+        self.assertEquals(cache2.get_keys(KEYGROUP, 'build_indexes'), [key])
+
+    def test_scan_keys(self):
+        keys = [cache2.create_key(KEYGROUP, 'scan_keys', val) for val in self.test_vals]
+
+        testkeys = cache2.scan_keys(cache2.DELIM.join([KEYGROUP, 'scan_keys', cache2.WILDCARD]), count=2)
+        self.assertItemsEqual(keys, list(testkeys))
+        self.assertItemsEqual(keys, list(cache2.iter_keys(KEYGROUP, 'scan_keys')))
 
     def test_get_keys(self):
         keys = []
         for val in self.test_vals:
-            key = cache2.DELIM.join([KEYGROUP, val])
-            cache2.keystore.rpush(key, val)
+            key = cache2.create_key(KEYGROUP, val)
             keys.append(key)
 
         # get all of the keys in a group
@@ -77,8 +154,7 @@ class TestCache2(unittest.TestCase):
 
         # get keys using *params
         for val in self.test_vals:
-            key = cache2.DELIM.join([KEYGROUP, 'multi-args', val])
-            cache2.keystore.rpush(key, val)
+            key = cache2.create_key(KEYGROUP, 'multi-args', val)
             testkeys = cache2.get_keys(KEYGROUP, 'multi-args', val)
             self.assertEquals(testkeys, [key], 'get_keys: keygroup + *identifier retrieval fails')
 
@@ -86,9 +162,9 @@ class TestCache2(unittest.TestCase):
         keyname = 'get_key_value'
         keyvalue = 'tests'
 
-        # tests using API method
+        # tests using API method, a key's values are kept in the ordered list store
         key = cache2.create_key(KEYGROUP, keyname, value=keyvalue)
-        testvalue = cache2.get_key_value(KEYGROUP, keyname)
+        testvalue = cache2.lpeek(KEYGROUP, keyname)
 
         self.assertEquals(keyvalue, testvalue, 'get_key_value fails')
 
@@ -101,7 +177,7 @@ class TestCache2(unittest.TestCase):
             cache2.add_item(KEYGROUP, keyname, item)
 
         listkey = cache2.DELIM.join([cache2.LIST, KEYGROUP, keyname])
-        items = cache2.datastore.smembers(listkey)
+        items = cache2.liststore.smembers(listkey)
         self.assertItemsEqual(items, self.identifiers, 'add_item fails')
 
 
@@ -112,7 +188,7 @@ class TestCache2(unittest.TestCase):
             cache2.add_item2(key, item)
 
         listkey = cache2.DELIM.join([cache2.LIST, key])
-        items = cache2.datastore.smembers(listkey)
+        items = cache2.liststore.smembers(listkey)
         self.assertItemsEqual(items, self.identifiers, 'add_item2 fails')
 
 
@@ -120,11 +196,11 @@ class TestCache2(unittest.TestCase):
         keyname = 'clear_items'
         listkey = cache2.DELIM.join([cache2.LIST, KEYGROUP, keyname])
         for item in self.test_vals:
-            cache2.datastore.sadd(listkey, item)
+            cache2.liststore.sadd(listkey, item)
 
         cache2.clear_items(KEYGROUP, keyname)
 
-        items = cache2.datastore.smembers(listkey)
+        items = cache2.liststore.smembers(listkey)
         self.assertItemsEqual(items, [], 'clear_items fails')
 
 
@@ -135,7 +211,7 @@ class TestCache2(unittest.TestCase):
         cache2.clear_items2(key)
 
         listkey = cache2.DELIM.join([cache2.LIST, key])
-        items = cache2.datastore.smembers(listkey)
+        items = cache2.liststore.smembers(listkey)
         self.assertItemsEqual(items, [], 'clear_items2 fails')
 
 
@@ -143,12 +219,79 @@ class TestCache2(unittest.TestCase):
         keyname = 'get_items'
         listkey = cache2.DELIM.join([cache2.LIST, KEYGROUP, keyname])
         for item in self.test_vals:
-            cache2.datastore.sadd(listkey, item)
+            cache2.liststore.sadd(listkey, item)
 
         items = cache2.get_items(KEYGROUP, keyname)
         self.assertItemsEqual(items, self.test_vals, 'get_items fails')
 
 
+    def test_policy(self):
+        cache2.set_policy(KEYGROUP, ttl=60, limit=3)
+        try:
+            keys = [cache2.create_key(KEYGROUP, 'policy', val) for val in self.test_vals]
+            cache2.set_hash2(keys[-1], {'operation': 'scan'})
+            cache2.enforce_policy(keys[-1])
+
+            remaining = cache2.get_keys(KEYGROUP, 'policy')
+            self.assertEquals(len(remaining), 3)
+            self.assertIn(keys[-1], remaining)
+            self.assertTrue(0 < cache2.keystore.ttl(keys[-1]) <= 60)
+            self.assertTrue(0 < cache2.hashstore.ttl(cache2.DELIM.join([cache2.HASH, keys[-1]])) <= 60)
+        finally:
+            del cache2.policies[KEYGROUP]
+
+    def test_policy_fields(self):
+        cache2.set_policy(KEYGROUP, limit=3, depth=2, count_fields=True)
+        try:
+            keys = [cache2.create_key(KEYGROUP, 'fields', val) for val in ['a', 'b', 'c']]
+            for key in keys:
+                cache2.set_hash2(key, {'x': 1, 'y': 2})
+
+            self.assertEquals(cache2.enforce_policy(keys[-1]), keys[:2])
+            self.assertEquals(cache2.get_keys(KEYGROUP, 'fields'), [keys[-1]])
+        finally:
+            del cache2.policies[KEYGROUP]
+
+    def test_policy_partitions(self):
+        cache2.set_policy(KEYGROUP, ttl=60, depth=2)
+        try:
+            exited = cache2.create_key(KEYGROUP, 'exited', 'a')
+            key = cache2.create_key(KEYGROUP, 'running', 'a')
+            exited_age = cache2.age_name(exited, cache2.policies[KEYGROUP])
+            cache2.keystore.zadd(exited_age, exited, 0)
+
+            # expired keys are forgotten in partitions no process writes to anymore
+            cache2.enforce_policy(key)
+            self.assertEquals(cache2.keystore.zcard(exited_age), 0)
+            self.assertEquals(cache2.keystore.smembers(cache2.partitions_name(KEYGROUP)),
+                              set([cache2.age_name(key, cache2.policies[KEYGROUP])]))
+            self.assertEquals(cache2.get_keys(KEYGROUP), [key])
+        finally:
+            del cache2.policies[KEYGROUP]
+
+    def test_local_tier(self):
+        keyname = 'local_tier'
+        listkey = cache2.DELIM.join([cache2.LIST, KEYGROUP, keyname])
+        cache2.enable_local_tier(notify=False)
+        try:
+            cache2.add_item(KEYGROUP, keyname, 'a')
+            self.assertItemsEqual(cache2.get_items(KEYGROUP, keyname, local=True), ['a'])
+
+            # writes that bypass cache2 are not seen until the entry expires
+            cache2.liststore.sadd(listkey, 'b')
+            self.assertItemsEqual(cache2.get_items(KEYGROUP, keyname, local=True), ['a'])
+            self.assertItemsEqual(cache2.get_items(KEYGROUP, keyname), ['a', 'b'])
+
+            # writes made through cache2 evict the entry
+            cache2.add_item(KEYGROUP, keyname, 'c')
+            self.assertItemsEqual(cache2.get_items(KEYGROUP, keyname, local=True), ['a', 'b', 'c'])
+
+            # and so does flushing the stores
+            cache2.flush_values()
+            self.assertItemsEqual(cache2.get_items(KEYGROUP, keyname, local=True), [])
+        finally:
+            cache2.disable_local_tier()
+
     # def test_get_items2(self):
     #     keyname = 'get_items'
     #     key = cache2.create_key(KEYGROUP, keyname)
@@ -172,10 +315,10 @@ class TestCache2(unittest.TestCase):
         self.assertEquals(pa, 'a')
         self.assertEquals(pd, 'd')
 
-        a = cache2.datastore.rpop(KEYGROUP)
-        b = cache2.datastore.rpop(KEYGROUP)
-        c = cache2.datastore.rpop(KEYGROUP)
-        d = cache2.datastore.rpop(KEYGROUP)
+        a = cache2.orderedliststore.rpop(KEYGROUP)
+        b = cache2.orderedliststore.rpop(KEYGROUP)
+        c = cache2.orderedliststore.rpop(KEYGROUP)
+        d = cache2.orderedliststore.rpop(KEYGROUP)
 
         self.assertEquals(a, 'a')
         self.assertEquals(b, 'b')
@@ -191,10 +334,10 @@ class TestCache2(unittest.TestCase):
         self.assertEquals(pa, 'a')
         self.assertEquals(pd, 'd')
 
-        a = cache2.datastore.lpop(KEYGROUP)
-        b = cache2.datastore.lpop(KEYGROUP)
-        c = cache2.datastore.lpop(KEYGROUP)
-        d = cache2.datastore.lpop(KEYGROUP)
+        a = cache2.orderedliststore.lpop(KEYGROUP)
+        b = cache2.orderedliststore.lpop(KEYGROUP)
+        c = cache2.orderedliststore.lpop(KEYGROUP)
+        d = cache2.orderedliststore.lpop(KEYGROUP)
 
         self.assertEquals(a, 'a')
         self.assertEquals(b, 'b')
@@ -281,6 +424,19 @@ class TestCache2(unittest.TestCase):
         cache2.add_hashset(KEYGROUP, keyname, hash)
 
         comp = cache2.get_hashsets(KEYGROUP, keyname)
+        self.assertEquals(comp, [hash])
+
+    def test_get_hashsets(self):
+        keyname = 'get_hashsets'
+        hashes = [{'operation': 'scan', 'operator': 'id3v2'}, {'operation': 'read', 'operator': 'mutagen'}]
+
+        for hash in hashes:
+            cache2.add_hashset(KEYGROUP, keyname, hash)
+
+        self.assertEquals(cache2.get_hashsets(KEYGROUP, keyname), hashes)
+
+        cache2.clear_hashsets(KEYGROUP, keyname)
+        self.assertEquals(cache2.get_hashsets(KEYGROUP, keyname), [])
 
     def test_get_hashset(self):
         keyname = 'add_hashset'
@@ -291,5 +447,47 @@ class TestCache2(unittest.TestCase):
 
 
 
+class TestCache2Shared(TestCache2):
+    """runs the cache2 tests against namespaced stores sharing one connection"""
+    shared = True
+
+    def test_shared_batch(self):
+        with cache2.batch(transaction=True) as batch:
+            key = cache2.create_key(KEYGROUP, 'shared_batch', value='tests')
+            cache2.set_hash2(key, {'operation': 'scan'})
+            self.assertEquals(len(batch.pipes), 1, 'namespaced stores should share one pipeline')
+
+        self.assertDictEqual(cache2.get_hash2(key), {'operation': 'scan'})
+        self.assertEquals(cache2.hashstore.client.hgetall('h:' + cache2.DELIM.join([cache2.HASH, key])), {'operation': 'scan'})
+
+
+class TestCache2Memory(TestCache2):
+    """runs the cache2 tests against the in-process memory backend, no Redis required"""
+    backend = 'memory'
+
+    def test_memory_script(self):
+        keyname = cache2.key_name(KEYGROUP, 'memory_script')
+        self.assertEquals(cache2.run_script(cache2.liststore, cache2.RESERVE_MEMBER, keys=[keyname], args=['x']), 0)
+        self.assertEquals(cache2.run_script(cache2.liststore, cache2.RESERVE_MEMBER, keys=[keyname], args=['x']), 1)
+        self.assertEquals(cache2.liststore.smembers(keyname), set(['x:0', 'x:1']))
+
+    def test_memory_ranges(self):
+        keyname = cache2.key_name(KEYGROUP, 'memory_ranges')
+        for score, member in [(2, 'c'), (1, 'b'), (1, 'a'), (3, 'd')]:
+            cache2.keystore.zadd(keyname, member, score)
+        cache2.keystore.zadd(keyname, 'a', 4)
+
+        self.assertEquals(cache2.keystore.zrange(keyname, 0, -1), ['b', 'c', 'd', 'a'])
+        self.assertEquals(cache2.keystore.zrange(keyname, -2, -1, desc=True), ['c', 'b'])
+        self.assertEquals(cache2.keystore.zrangebyscore(keyname, '(1', 3), ['c', 'd'])
+        self.assertEquals(cache2.keystore.zrangebyscore(keyname, '-inf', '+inf', start=1, num=2), ['c', 'd'])
+
+        lexname = cache2.key_name(KEYGROUP, 'memory_lex')
+        for member in ['a', 'ab', 'b', 'ba', 'c']:
+            cache2.keystore.zadd(lexname, member, 0)
+        self.assertEquals(cache2.keystore.zrangebylex(lexname, '(a', '[b'), ['ab', 'b'])
+        self.assertEquals(cache2.keystore.zrangebylex(lexname, '[b', '+', start=1, num=5), ['ba', 'c'])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
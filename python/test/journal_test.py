@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..server.core.journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'ops.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_per_process(self):
+        first = Journal(self.path, pid='100')
+        first.append({'pid': '100'})
+        self.assertEquals(first.path, os.path.join(self.workdir, 'ops.100.journal'))
+
+        # 100 is still running, its entries stay where they are
+        second = Journal(self.path, pid='200')
+        self.assertEquals(second.pending, [])
+        self.assertRaises(IOError, Journal, self.path, pid='200')
+
+    def test_adopt(self):
+        exited = Journal(self.path, pid='100')
+        exited.append({'pid': '100', 'index': 0})
+        exited.take()
+        exited.append({'pid': '100', 'index': 1})
+        exited.lock_file.close()
+
+        journal = Journal(self.path, pid='200')
+        self.assertEquals([entry['index'] for entry in journal.pending], [0, 1])
+        self.assertEquals(sorted(os.listdir(self.workdir)), ['ops.200.journal', 'ops.200.journal.lock'])
+
+        # the adopted entries are on disk under the new journal
+        journal.lock_file.close()
+        self.assertEquals(len(Journal(self.path, pid='300').pending), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
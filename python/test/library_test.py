@@ -4,6 +4,10 @@ import redis
 
 from ..server import config
 from ..server import const
+# ops before start and shallow before assets, each imports the other
+from ..server import ops
+from ..server import start
+from ..server import shallow
 from ..server import assets
 from ..server import sql
 from ..server.core import cache2
@@ -26,36 +30,64 @@ class TestLibrary(unittest.TestCase):
 
         rows = sql.run_query_template(RETRIEVE_DOCS, config.es_index, const.FILE, path, 
             schema=config.db_media)
-        keys = cache2.get_keys(cache2.DELIM.join([assets.KEY_GROUP, const.FILE, path]))
-        self.assertEqual(len(rows), len(keys))
+        docs = assets.get_cached_docs(const.FILE, path)
+        self.assertEqual(len(rows), len(docs))
 
 
     def test_clear_docs(self):
         path = '/media/removable/Audio/music/albums/ambient/biosphere/substrata'
         assets.cache_docs(const.FILE, path)
 
-        dockeys = cache2.get_keys(assets.KEY_GROUP, const.FILE, path)
-        self.assertEquals(len(dockeys), 12)
+        docs = assets.get_cached_docs(const.FILE, path)
+        self.assertEquals(len(docs), 12)
 
-        cache2.create_key(assets.KEY_GROUP, const.FILE, '/some/other/path', value='/some/other/path')
+        assets.cache_esids(const.FILE, '/some/other/path', {'/some/other/path/file': '0123456789'})
         assets.clear_docs(const.FILE, path)
 
-        dockeys = cache2.get_keys(assets.KEY_GROUP, const.FILE, path)
-        self.assertEquals(len(dockeys), 0)
+        docs = assets.get_cached_docs(const.FILE, path)
+        self.assertEquals(len(docs), 0)
 
-        dockeys = cache2.get_keys(assets.KEY_GROUP, const.FILE, '/some/other/path')
-        self.assertEquals(len(dockeys), 1)
+        docs = assets.get_cached_docs(const.FILE, '/some/other/path')
+        self.assertEquals(len(docs), 1)
 
 
     def test_get_cached_esid(self):
         path = '/media/removable/Audio/music/albums/ambient/biosphere/substrata'
         asset_type = const.DIRECTORY
 
-        key = cache2.create_key(assets.KEY_GROUP, asset_type, path, value=path)
-        cache2.set_hash2(key, {'absolute_path':path, 'esid': '0123456789'})
+        assets.cache_esids(asset_type, path, {path: '0123456789'})
 
         esid = assets.get_cached_esid(asset_type, path)
         self.assertEquals(esid, '0123456789')
 
-    if __name__ == '__main__':
-        unittest.main()
\ No newline at end of file
+
+class TestCachedRoots(unittest.TestCase):
+    """runs against the in-process memory backend, no Redis required"""
+    def setUp(self):
+        start.initialize_cache2('localhost', backend='memory')
+        cache2.flush_all()
+        assets.cached_roots.clear()
+        assets.cached_keys.clear()
+        self.policy = cache2.policies[assets.KEY_GROUP]
+        cache2.set_policy(assets.KEY_GROUP, limit=2, depth=2, count_fields=True)
+
+    def tearDown(self):
+        cache2.policies[assets.KEY_GROUP] = self.policy
+
+    def test_evict(self):
+        assets.cache_esids(const.FILE, '/lib/a', {'/lib/a/x': '1', '/lib/a/y': '2'})
+        assets.cache_esids(const.FILE, '/lib/a/b', {'/lib/a/b/x': '3', '/lib/a/b/y': '4'})
+
+        # /lib/a is the oldest root over the limit, its paths are no longer cached
+        self.assertEquals(list(assets.cached_roots[const.FILE]), ['/lib/a/b'])
+        self.assertEquals(assets.cached_keys.values(), ['/lib/a/b'])
+        self.assertIsNone(assets.get_cached_esid(const.FILE, '/lib/a/x'))
+        self.assertEquals(assets.get_cached_esid(const.FILE, '/lib/a/b/x'), '3')
+
+        assets.cache_esids(const.FILE, '/lib/c', {'/lib/c/x': '5', '/lib/c/y': '6'})
+        self.assertEquals(list(assets.cached_roots[const.FILE]), ['/lib/c'])
+        self.assertIsNone(assets.get_cached_esid(const.FILE, '/lib/a/b/x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+from ..server.core.patterns import PatternSet
+
+
+class TestPatternSet(unittest.TestCase):
+    def setUp(self):
+        self.patterns = PatternSet(['/compilations', 'compilations/', '/compilations/', 'various', ''])
+
+    def test_search(self):
+        self.assertEquals(self.patterns.search('/media/library/compilations/various artists'),
+                          set(['/compilations', 'compilations/', '/compilations/', 'various']))
+        self.assertEquals(self.patterns.search('/media/library/compilations'), set(['/compilations']))
+        self.assertEquals(self.patterns.search('/media/library/artist'), set())
+
+    def test_overlapping(self):
+        # matches that start at the same position, or overlap, are all reported
+        self.assertEquals(PatternSet(['ab', 'abc', 'bcd']).search('xabcdx'), set(['ab', 'abc', 'bcd']))
+
+    def test_escaped(self):
+        self.assertEquals(PatternSet(['[live]', 'a.b']).search('/music/[live]/axb'), set(['[live]']))
+
+    def test_empty(self):
+        self.assertEquals(PatternSet([]).search('/media/library'), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
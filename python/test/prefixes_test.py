@@ -0,0 +1,31 @@
+import unittest
+
+from ..server.core.prefixes import PrefixIndex
+
+
+class TestPrefixIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = PrefixIndex(['/media/library', '/media/library/compilations', '/media/incoming/'])
+
+    def test_longest(self):
+        self.assertEquals(self.index.longest('/media/library/artist/album/01 track.mp3'), '/media/library')
+        self.assertEquals(self.index.longest('/media/library/compilations/various'), '/media/library/compilations')
+        self.assertEquals(self.index.longest('/media/incoming/album'), '/media/incoming/')
+        self.assertEquals(self.index.longest('/media/library'), '/media/library')
+
+    def test_components(self):
+        # a root contains its descendants, not every path it is a prefix of
+        self.assertIsNone(self.index.longest('/media/library2/album'))
+        self.assertIsNone(self.index.longest('/media'))
+
+    def test_remove(self):
+        self.index.remove('/media/library/compilations')
+        self.assertEquals(self.index.longest('/media/library/compilations/various'), '/media/library')
+        self.index.remove('/media/library')
+        self.assertIsNone(self.index.longest('/media/library/compilations/various'))
+        self.assertEquals(self.index.trie, {'media': {'incoming': {None: '/media/incoming/'}}})
+        self.assertEquals(list(self.index), ['/media/incoming/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
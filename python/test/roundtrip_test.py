@@ -0,0 +1,240 @@
+"""counts the Redis commands and round trips each hot cache2, ops and assets call costs, and times it, against the
+memory backend. run as a test it fails when a call needs more commands than its budget; run directly
+(python -m python.test.roundtrip_test [redis]) it prints a report"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# ops before start and shallow before assets, each imports the other
+from ..server import ops
+from ..server import start
+from ..server import shallow
+from ..server import assets
+from ..server.alchemy import SQLOperationRecord
+from ..server.const import DIRECTORY
+from ..server.core import cache2
+from ..server.core.progress import Progress
+
+
+STORES = ('keystore', 'datastore', 'hashstore', 'liststore', 'orderedliststore')
+
+LIBRARY = '/media/library'
+PATH = '/media/library/artist/album/01 track.mp3'
+# a directory listing, resolved as a whole
+LISTING = ['/media/library/artist/album/%02i track.mp3' % number for number in range(1, 51)]
+
+# most commands a call may send on average (create_key enforces policies every few calls), raise these deliberately
+BUDGETS = {
+    'cache2.get_key': 1,
+    'cache2.set_hash2': 2,
+    'cache2.get_hashsets': 3,
+    'ops.operation_in_cache': 0,
+    'ops.record_op_begin': 9,
+    'ops.record_op_complete': 4,
+    'assets.retrieve_asset': 3,
+    'assets.resolve_assets': 3,
+}
+
+
+class Counter(object):
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    def count(self, commands, round_trips=1):
+        self.commands += commands
+        self.round_trips += round_trips
+
+    def reset(self):
+        self.commands = 0
+        self.round_trips = 0
+
+
+class CountedPipeline(object):
+    def __init__(self, pipe, counter):
+        self.pipe = pipe
+        self.counter = counter
+        self.queued = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipe, name)
+        if name == 'execute':
+            def execute(*args, **kwargs):
+                self.counter.count(self.queued)
+                self.queued = 0
+                return attr(*args, **kwargs)
+            return execute
+
+        if name == 'reset':
+            self.queued = 0
+            return attr
+
+        if not callable(attr):
+            return attr
+
+        def queue(*args, **kwargs):
+            self.queued += 1
+            return attr(*args, **kwargs)
+        return queue
+
+
+class CountedScript(object):
+    def __init__(self, script, counter):
+        self.script = script
+        self.counter = counter
+
+    def __call__(self, *args, **kwargs):
+        self.counter.count(1)
+        return self.script(*args, **kwargs)
+
+
+class Counted(object):
+    """wraps a client so that every command it sends is counted. a pipeline counts its queued commands as one round
+    trip on execute. scan_iter counts once per call, though Redis needs a SCAN per scan_count keys"""
+    def __init__(self, client, counter):
+        self.client = client
+        self.counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name == 'pipeline':
+            return lambda *args, **kwargs: CountedPipeline(attr(*args, **kwargs), self.counter)
+
+        if name == 'register_script':
+            return lambda source: CountedScript(attr(source), self.counter)
+
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            self.counter.count(1)
+            return attr(*args, **kwargs)
+        return command
+
+
+def instrument(counter):
+    """route the commands of every cache2 store through counter"""
+    counted = {}
+    for name in STORES:
+        store = getattr(cache2, name)
+        if isinstance(store, cache2.Namespace):
+            # namespaces on one client must stay on one (counted) client, or batches would split across pipelines
+            client = store.client
+            store.client = counted.setdefault(id(client), Counted(client, counter))
+        else:
+            setattr(cache2, name, Counted(store, counter))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def measure(counter, call, setup=None, repeat=100):
+    """run call repeat times, setup (uncounted, untimed) before each. returns commands and round trips per call and
+    latency percentiles in milliseconds"""
+    commands = round_trips = 0
+    samples = []
+    for iteration in range(repeat):
+        if setup:
+            setup()
+        counter.reset()
+        began = time.time()
+        call()
+        samples.append((time.time() - began) * 1000)
+        commands += counter.commands
+        round_trips += counter.round_trips
+
+    return {'commands': commands / float(repeat), 'round_trips': round_trips / float(repeat),
+            'p50': percentile(samples, 50), 'p90': percentile(samples, 90), 'p99': percentile(samples, 99)}
+
+
+def prepare():
+    """seed what the hot paths expect to find: a compound key, hashsets, the exec record and the library directory"""
+    key = cache2.create_key('roundtrip', 'key')
+    cache2.set_hash2(key, {'operation': 'scan', 'persisted': 'True'})
+    for index in range(3):
+        cache2.add_hashset('roundtrip', 'hashsets', {'index': index})
+
+    exec_key = ops.get_exec_key()
+    cache2.set_hash2(exec_key, {'pid': ops.config.pid, 'stop_requested': 'False', 'halt_requested': 'False'})
+    cache2.add_items2(cache2.get_key(DIRECTORY, 'directories'), [LIBRARY])
+
+    ops.cache_op(SQLOperationRecord(operation_name='scan', operator_name='roundtrip', target_path=PATH), root=LIBRARY)
+    assets.cache_esids(assets.const.FILE, LIBRARY, {PATH: 'roundtrip'})
+    return key
+
+
+def cases(key):
+    """name -> (call, setup)"""
+    return {
+        'cache2.get_key': (lambda: cache2.get_key('roundtrip', 'key'), None),
+        'cache2.set_hash2': (lambda: cache2.set_hash2(key, {'operation': 'scan', 'persisted': 'True'}), None),
+        'cache2.get_hashsets': (lambda: cache2.get_hashsets('roundtrip', 'hashsets'), None),
+        'ops.operation_in_cache': (lambda: ops.operation_in_cache(PATH, 'scan', 'roundtrip'), None),
+        'ops.record_op_begin': (lambda: ops.record_op_begin(PATH, 'read', 'roundtrip'),
+                                lambda: ops.record_op_complete(PATH, 'read', 'roundtrip')),
+        'ops.record_op_complete': (lambda: ops.record_op_complete(PATH, 'read', 'roundtrip'),
+                                   lambda: ops.record_op_begin(PATH, 'read', 'roundtrip')),
+        'assets.retrieve_asset': (lambda: assets.retrieve_asset(PATH, check_db=False), None),
+        'assets.resolve_assets': (lambda: assets.resolve_assets(LISTING, check_db=False), None),
+    }
+
+
+def initialize(backend='memory'):
+    start.initialize_cache2('localhost', key_db=10, data_db=11, hash_db=12, list_db=13, ord_list_db=14,
+                            backend=backend)
+    cache2.flush_all()
+    # progress is published when it is due, which depends on timing. publishing on flush() only keeps the counts exact
+    ops.PROGRESS = Progress(ops.PROGRESS.publish, rate=0)
+    counter = Counter()
+    instrument(counter)
+    return counter, cases(prepare())
+
+
+class TestRoundTrips(unittest.TestCase):
+    def setUp(self):
+        self.counter, self.cases = initialize()
+
+    def tearDown(self):
+        cache2.flush_all()
+
+    def test_budgets(self):
+        for name in sorted(BUDGETS):
+            call, setup = self.cases[name]
+            result = measure(self.counter, call, setup=setup)
+            self.assertLessEqual(result['commands'], BUDGETS[name], '%s sends %.2f commands, budget is %i' %
+                                 (name, result['commands'], BUDGETS[name]))
+
+    def test_journal(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            ops.open_journal(os.path.join(workdir, 'ops.journal'), interval=3600)
+            call, setup = self.cases['ops.record_op_begin']
+            self.assertEquals(measure(self.counter, call, setup=setup)['commands'], 0)
+
+            ops.flush_journal()
+            record = cache2.get_hash2(cache2.key_name(ops.OPS, ops.config.pid, 'read', 'roundtrip', PATH))
+            self.assertEquals(record['status'], 'ACTIVE')
+        finally:
+            ops.journal = None
+            shutil.rmtree(workdir)
+
+
+def report(backend='memory', repeat=1000):
+    counter, calls = initialize(backend)
+    print('%-24s %9s %12s %9s %9s %9s' % ('call', 'commands', 'round trips', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name in sorted(calls):
+        call, setup = calls[name]
+        result = measure(counter, call, setup=setup, repeat=repeat)
+        print('%-24s %9.1f %12.1f %9.3f %9.3f %9.3f' % (name, result['commands'], result['round_trips'],
+                                                       result['p50'], result['p90'], result['p99']))
+    cache2.flush_all()
+
+
+if __name__ == '__main__':
+    report(*sys.argv[1:2])